@@ -4,18 +4,32 @@ import boto3
 import logging
 import os
 import io
+import bz2
+import gzip
+import hashlib
 import time
 import pandas as pd
-import numpy as np
 import pickle
+import json
+import re
 import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from multiprocessing import Pool, cpu_count
-from queue import Queue
 from scipy.spatial import cKDTree
 import datetime as dt
+import s3_cache
 from config import settings
 from crypto import security
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 # Config settings
 S3_USER = settings['S3_info']['S3_USER']
 S3_SECRET_KEY = settings['S3_info']['SECRET_KEY']
@@ -23,12 +37,39 @@ S3_BUCKET = settings['S3_info']['S3_BUCKET']
 S3_ENDPOINT = settings['S3_info']['S3_ENDPOINT']
 LOG_FILE_PATH = settings['logging']['Log_file_path']
 S3_PATH_FOR_DOWNLOADING_project_DATA = settings['S3_info']['S3_PATH_FOR_DOWNLOADING_project_DATA']
+S3_PREFIX_FOR_DOWNLOADING_project_DATA = settings['S3_info'].get('S3_PREFIX_FOR_DOWNLOADING_project_DATA', '')
+S3_MANIFEST_FILE = settings['S3_info'].get('S3_MANIFEST_FILE', os.path.join(
+    os.path.dirname(os.path.abspath(settings['directories']['current_tree_folder'])), 'aws_s3_manifest.json'))
 
 crypt = security.PasswordHash
 key = os.environ['project_KEY']
 secure = crypt(key)
 decrypted_key = secure.decrypt(S3_SECRET_KEY)
 
+# Chunks of multi_processor are sized to take about this many seconds in a worker, within the row bounds
+TARGET_CHUNK_SECONDS = settings.get('aws_s3_config', {}).get('target_chunk_seconds', 2.0)
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 1000000
+
+# Uploads are sent in parts of UPLOAD_PART_SIZE bytes, frames are serialized UPLOAD_CHUNK_ROWS rows at a time
+UPLOAD_PART_SIZE = settings.get('aws_s3_config', {}).get('upload_part_size', 8 * 2 ** 20)
+# S3 rejects parts smaller than this, except for the last one
+MIN_UPLOAD_PART_SIZE = 5 * 2 ** 20
+UPLOAD_CHUNK_ROWS = 100000
+PARQUET_COMPRESSIONS = ['zstd', 'snappy', 'gzip', 'none']
+CSV_COMPRESSIONS = {'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='wb'), 'bz2': lambda f: bz2.BZ2File(f, 'wb')}
+CSV_EXTENSIONS = {'.csv.gz': 'gzip', '.csv.bz2': 'bz2'}
+
+# Concurrent downloads of download_object_from_s3, and the dtypes the project data columns are parsed with
+DOWNLOAD_CONCURRENCY = settings.get('aws_s3_config', {}).get('download_concurrency', 8)
+PROJECT_DATA_DTYPES = settings.get('aws_s3_config', {}).get('project_data_dtypes',
+                                                            {'City': 'object', 'active droids': 'float64'})
+
+# Local store of the weekly aggregates of the project data, see RollingAggregateStore
+PROJECT_AGGREGATE_FOLDER = settings.get('aws_s3_config', {}).get('project_aggregate_folder', 'project_aggregates')
+PROJECT_GROUP_COLUMNS = ['City', 'Day', 'Time']
+PROJECT_VALUE_COLUMN = 'active droids'
+
 
 def start_log():
     """
@@ -50,129 +91,461 @@ def start_log():
 
 def multi_processor(input_data, func_name, num_loops):
     """
-    multi_process processing
+    multi_process processing on the shared StreamingExecutor
     :param input_data: a data frame
-    :param func_name: the function which is going to be run
-    :param num_loops: number of loops is required for multiple processing
-    :return: a dictionary
+    :param func_name: the function which is going to be run, called with a chunk of the data frame and its index
+    :param num_loops: number of chunks per worker the data frame starts being split into
+    :return: the data frames returned for every chunk concatenated in chunk order, or a dictionary of chunk index to
+             result if the function does not return data frames
     """
-    try:
-        if len(input_data.index) > cpu_count() * num_loops:
-            combined_data = np.array_split(input_data, (cpu_count() - 1) * num_loops)
-        else:
-            combined_data = []
-            combined_data.append(input_data)
+    return get_executor().map_frame(input_data, func_name, num_loops)
+
+
+class ChunkError:
+    """
+    Failure of one chunk in a StreamingExecutor
+    """
+    def __init__(self, index, rows, error, trace):
+        self.index = index
+        self.rows = rows
+        self.error = error
+        self.traceback = trace
 
-        pool = Pool(processes=cpu_count() - 1)
-        pool.daemon = True
+    def __repr__(self):
+        return 'ChunkError(index=%d, rows=%d, error=%s)' % (self.index, self.rows, self.error)
+
+
+class ChunkProcessingException(Exception):
+    """
+    Raised by StreamingExecutor.map_frame once every chunk has finished if some of them failed. errors holds a
+    ChunkError per failed chunk, result the combined result of the chunks that succeeded
+    """
+    def __init__(self, errors, result=None):
+        super(ChunkProcessingException, self).__init__('%d chunk(s) failed: %s' % (len(errors), errors))
+        self.errors = errors
+        self.result = result
+
+
+class StreamingExecutor:
+    """
+    Persistent process pool running a function over the chunks of data frames. Chunks are cut lazily while the
+    workers consume them, at most max_pending at a time, and sized so a chunk takes about TARGET_CHUNK_SECONDS from
+    the throughput of the chunks already done. Results stream back as they finish
+    """
+    def __init__(self, processes=None, max_pending=None):
+        self.processes = processes or max(cpu_count() - 1, 1)
+        self.max_pending = max_pending or 2 * self.processes
+        self.pool = Pool(processes=self.processes)
+
+    def imap(self, input_data, func_name, num_loops=1):
+        """
+        Runs the function over chunks of the data frame
+        :param input_data: a data frame
+        :param func_name: the function which is going to be run, called with a chunk and its index
+        :param num_loops: number of chunks per worker the data frame starts being split into
+        :return: generator of (chunk index, result, ChunkError or None) in the order the chunks finish
+        """
+        pending = threading.BoundedSemaphore(self.max_pending)
+        cancelled = threading.Event()
+        throughput = {'rows': 0, 'seconds': 0.}
+        first_rows = -(-len(input_data.index) // (self.processes * num_loops))
+
+        def chunks():
+            start = 0
+            index = 0
+            while start < len(input_data.index) or index == 0:
+                # The pool's task thread runs this generator, it must not stay blocked once the caller stops reading
+                while not pending.acquire(timeout=0.1):
+                    if cancelled.is_set():
+                        return
+                if cancelled.is_set():
+                    return
+                if throughput['seconds'] > 0:
+                    rows = int(throughput['rows'] / throughput['seconds'] * TARGET_CHUNK_SECONDS)
+                    rows = min(max(rows, MIN_CHUNK_ROWS), MAX_CHUNK_ROWS)
+                else:
+                    rows = max(first_rows, 1)
+                yield func_name, input_data.iloc[start:start + rows], index
+                start += rows
+                index += 1
+
+        try:
+            for index, rows, seconds, result, error in self.pool.imap_unordered(run_chunk, chunks()):
+                pending.release()
+                throughput['rows'] += rows
+                throughput['seconds'] += seconds
+                yield index, result, error
+        finally:
+            cancelled.set()
+
+    def map_frame(self, input_data, func_name, num_loops=1):
+        """
+        Runs the function over chunks of the data frame and combines the results
+        :param input_data: a data frame
+        :param func_name: the function which is going to be run, called with a chunk and its index
+        :param num_loops: number of chunks per worker the data frame starts being split into
+        :return: the data frames returned for every chunk concatenated in chunk order, or a dictionary of chunk index
+                 to result if the function does not return data frames
+        """
         results = {}
+        errors = []
+        for index, result, error in self.imap(input_data, func_name, num_loops):
+            if error is not None:
+                logging.error("Multiprocessing chunk " + str(index) + " failed.\n" + error.traceback)
+                errors.append(error)
+            else:
+                results[index] = result
 
-        q = Queue()
-        for d in combined_data:
-            q.put(d)
+        frames = [results[x] for x in sorted(results) if isinstance(results[x], pd.DataFrame)]
+        combined = pd.concat(frames, ignore_index=True) if frames else results
+        if errors:
+            raise ChunkProcessingException(sorted(errors, key=lambda x: x.index), combined)
+        return combined
 
-        del combined_data
-        del input_data
-        for x in range(int(q.qsize())):
-            results[x] = pool.apply_async(func_name, args=(q.get(), x))
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
-        pool.close()
-        pool.join()
+    def __enter__(self):
+        return self
 
-        df_all = pd.concat(
-            {item: result.get() for item, result in results.items() if isinstance(result.get(), pd.DataFrame)},
-            ignore_index=True)
+    def __exit__(self, *args):
+        self.close()
 
-        if not df_all.empty:
-            return df_all
-        else:
-            return results
 
+def run_chunk(task):
+    """
+    Runs in a StreamingExecutor worker
+    :param task: (function, chunk, chunk index)
+    :return: chunk index, number of rows, seconds taken, result, ChunkError or None
+    """
+    func_name, chunk, index = task
+    start = time.time()
+    try:
+        result = func_name(chunk, index)
+        error = None
     except Exception as e:
-        logging.error("Multiprocessing failed.\n" + str(e))
-        sys.exit(0)
+        result = None
+        error = ChunkError(index, len(chunk.index), repr(e), traceback.format_exc())
+    return index, len(chunk.index), time.time() - start, result, error
+
+
+def get_executor():
+    """
+    :return: StreamingExecutor shared by the calls of multi_processor, started on first use
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = StreamingExecutor()
+        return executor
+
 
+executor = None
+executor_lock = threading.Lock()
 
-def upload_object_to_s3(object_to_save, s3_path):
+
+def upload_object_to_s3(object_to_save, s3_path, file_format=None, compression=None):
     """
-    upload df or KdTree to S3
-    :param object_to_save: a csv or tree file
-    :param s3_path: a string
+    upload df or KdTree to S3. The object is serialized a chunk at a time into a multipart upload, so only one part
+    is held in memory whatever its size
+    :param object_to_save: a data frame or tree
+    :param s3_path: a string, a .parquet, .csv.gz or .csv.bz2 key sets the default format and compression
+    :param file_format: 'csv' or 'parquet' for data frames, defaults to the format of the key, csv otherwise
+    :param compression: 'zstd', 'snappy', 'gzip' or 'none' for parquet, defaults to zstd, 'gzip' or 'bz2' for csv
     :return: none
     """
     logging.info("Uploading S3 file " + str(s3_path))
     try:
+        if not isinstance(object_to_save, (pd.DataFrame, cKDTree)):
+            raise ValueError('Unsupported object type ' + type(object_to_save).__name__)
+        file_format, compression = upload_format(s3_path, file_format, compression)
         s3_conn = boto3.client('s3', endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_USER,
                                aws_secret_access_key=decrypted_key)
-        if isinstance(object_to_save, pd.DataFrame):
-            buf = io.StringIO()
-            object_to_save.to_csv(buf, index=False)
-            s3_conn.put_object(Body=buf.getvalue(), Bucket=S3_BUCKET, Key=s3_path)
-
-        if isinstance(object_to_save, cKDTree):
-            buf = io.BytesIO()
-            pickle.dump(object_to_save, buf)
-            s3_conn.put_object(Body=buf.getvalue(), Bucket=S3_BUCKET, Key=s3_path)
+        with MultipartUploadWriter(s3_conn, S3_BUCKET, s3_path) as writer:
+            if isinstance(object_to_save, pd.DataFrame):
+                if file_format == 'parquet':
+                    write_parquet(object_to_save, writer, compression)
+                else:
+                    write_csv(object_to_save, writer, compression)
+            else:
+                pickle.dump(object_to_save, writer, protocol=pickle.HIGHEST_PROTOCOL)
     except Exception as e:
         logging.error("Uploading to S3 file failed. \n" + str(e))
         sys.exit(0)
 
 
-def s3_query(file_type):
+def upload_format(s3_path, file_format=None, compression=None):
+    """
+    :return: file format and compression of an upload, from the arguments or else the key
+    """
+    if file_format is None:
+        file_format = 'parquet' if s3_path.endswith('.parquet') else 'csv'
+    if file_format == 'parquet':
+        compression = compression or 'zstd'
+        if compression not in PARQUET_COMPRESSIONS:
+            raise ValueError('Unsupported parquet compression ' + str(compression))
+    elif file_format == 'csv':
+        if compression is None:
+            compression = next((y for x, y in CSV_EXTENSIONS.items() if s3_path.endswith(x)), None)
+        if compression not in CSV_COMPRESSIONS and compression is not None:
+            raise ValueError('Unsupported csv compression ' + str(compression))
+    else:
+        raise ValueError('Unsupported file format ' + str(file_format))
+    return file_format, compression
+
+
+def write_csv(df, f, compression=None):
+    """
+    Writes a data frame as csv, UPLOAD_CHUNK_ROWS rows at a time
+    :param df: a data frame
+    :param f: binary file object
+    :param compression: None, 'gzip' or 'bz2'
+    """
+    out = CSV_COMPRESSIONS[compression](f) if compression else f
+    for start in range(0, max(len(df.index), 1), UPLOAD_CHUNK_ROWS):
+        out.write(df.iloc[start:start + UPLOAD_CHUNK_ROWS].to_csv(header=start == 0, index=False).encode('utf-8'))
+    if compression:
+        out.close()
+
+
+def write_parquet(df, f, compression='zstd'):
+    """
+    Writes a data frame as parquet, one row group per UPLOAD_CHUNK_ROWS rows
+    :param df: a data frame
+    :param f: binary file object
+    :param compression: 'zstd', 'snappy', 'gzip' or 'none'
+    """
+    if pa is None:
+        raise ImportError('pyarrow is not installed, parquet uploads are unavailable')
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(f, schema, compression=compression) as parquet_writer:
+        for start in range(0, max(len(df.index), 1), UPLOAD_CHUNK_ROWS):
+            chunk = df.iloc[start:start + UPLOAD_CHUNK_ROWS]
+            parquet_writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write only file object uploading to S3 in parts of part_size bytes, so at most one part is buffered. Objects
+    smaller than a part are sent with a single put_object. Leaving a with block on an exception aborts the upload
     """
-    given the file type, find the file list in S3
+    def __init__(self, s3_conn, bucket, key, part_size=None):
+        super(MultipartUploadWriter, self).__init__()
+        self.s3_conn = s3_conn
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or UPLOAD_PART_SIZE
+        if self.part_size < MIN_UPLOAD_PART_SIZE:
+            raise ValueError('upload_part_size has to be at least %d bytes' % MIN_UPLOAD_PART_SIZE)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = memoryview(data).nbytes
+        self.buffer += data
+        self.size += size
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return size
+
+    def tell(self):
+        return self.size
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_conn.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_conn.upload_part(Body=body, Bucket=self.bucket, Key=self.key, PartNumber=part_number,
+                                            UploadId=self.upload_id)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3_conn.put_object(Body=bytes(self.buffer), Bucket=self.bucket, Key=self.key)
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                self.s3_conn.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                       MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            super(MultipartUploadWriter, self).close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_conn.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+        super(MultipartUploadWriter, self).close()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def s3_query(file_type, prefix='', num_weeks=None):
+    """
+    given the file type, find the file list in S3. The date partitions directly under the prefix are listed first,
+    folders like 2019-01-07/ or files like 2019-01-07.csv, then only the folders of the newest num_weeks partitions
+    holding matching files. Folder listings are kept in a local manifest, all but the newest one are reused on the
+    next refresh. Without date partitions under the prefix every key under it is listed
     :param file_type: a csv or tree file
+    :param prefix: only keys starting with the prefix are listed
+    :param num_weeks: number of weeks needed, all weeks if None
     :return: the files downloaded from S3
     """
     try:
-        s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_USER, aws_secret_access_key=decrypted_key)
-        bucket = s3.Bucket(S3_BUCKET)
-        files = []
+        s3_conn = boto3.client('s3', endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_USER,
+                               aws_secret_access_key=decrypted_key)
+        folders, keys = list_s3_level(s3_conn, prefix, '/')
+        partitions = dict((x, None) for x in folders if partition_date(x))
+        partitions.update((x, [x]) for x in keys if partition_date(x))
+        if not partitions:
+            logging.warning('No date partitions under S3 prefix "' + prefix + '", listing every key')
+            return [key for key in list_s3_level(s3_conn, prefix)[1] if file_type in key]
+
+        try:
+            with open(S3_MANIFEST_FILE) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+        old_listings = manifest.get(S3_BUCKET, {})
+        listings = manifest[S3_BUCKET] = {}
 
-        for object in bucket.objects.all():
-            if file_type in object.key:
-                files.append(object.key)
+        files = []
+        weeks = 0
+        newest = max(partitions, key=partition_date)
+        for partition in sorted(partitions, key=partition_date, reverse=True):
+            if num_weeks is not None and weeks >= num_weeks:
+                break
+            partition_keys = partitions[partition]
+            if partition_keys is None:
+                # The newest partition may still be filling up, it is always listed again
+                if partition in old_listings and partition != newest:
+                    partition_keys = old_listings[partition]
+                else:
+                    partition_keys = list_s3_level(s3_conn, partition)[1]
+                listings[partition] = partition_keys
+            matches = [key for key in partition_keys if file_type in key]
+            files += matches
+            weeks += 1 if matches else 0
+
+        # Partitions no longer in S3 or out of the window are dropped from the manifest
+        tmp_file = S3_MANIFEST_FILE + '.tmp'
+        with open(tmp_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_file, S3_MANIFEST_FILE)
         return files
     except Exception as e:
         logging.error("Finding the file list in S3 failed. \n" + str(e))
         sys.exit(0)
 
 
-def download_object_from_s3(file_list, file_type):
+def list_s3_level(s3_conn, prefix, delimiter=None):
     """
-    download data (csv or tree) from S3
-    :param file_list: a list of files
-    :param file_type: could be csv or tree
-    :return: a object list if input file is csv, or return a dictionary list if input is tree
+    Lists the bucket under the prefix page by page
+    :param s3_conn: S3 client
+    :param prefix: only keys starting with the prefix are listed
+    :param delimiter: if given, keys containing it after the prefix are grouped into common prefixes
+    :return: list of common prefixes, list of keys
     """
-    try:
-        object_list = []
-        object_dictionary = {}
-        s3_conn = boto3.client('s3', endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_USER,
-                               aws_secret_access_key=decrypted_key)
+    kwargs = {'Bucket': S3_BUCKET, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    common_prefixes = []
+    keys = []
+    while True:
+        response = s3_conn.list_objects_v2(**kwargs)
+        common_prefixes += [x['Prefix'] for x in response.get('CommonPrefixes', [])]
+        keys += [x['Key'] for x in response.get('Contents', [])]
+        if not response.get('IsTruncated'):
+            return common_prefixes, keys
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def partition_date(name):
+    """
+    :param name: common prefix or key directly under the listed prefix
+    :return: the yyyy-mm-dd date in its last path segment, None if there is none
+    """
+    match = re.search(r'\d{4}-\d{2}-\d{2}', name.rstrip('/').rsplit('/', 1)[-1])
+    return match.group(0) if match else None
 
-        for each_file in file_list:
 
-            obj = s3_conn.get_object(Bucket=S3_BUCKET, Key=each_file)
-            body = obj['Body']
-            if file_type == ".csv":
-                csv_string = body.read().decode('utf-8')
-                df = pd.read_csv(io.StringIO(csv_string))
-                object_list.append(df)
-            elif file_type == ".tree":
-                var = pickle.loads(body.read())
-                object_dictionary[str(each_file)] = var
+def download_object_from_s3(file_list, file_type, max_workers=None):
+    """
+    download data (csv, parquet or tree) from S3. Files are fetched concurrently over one shared client and parsed
+    straight from the response stream
+    :param file_list: a list of files
+    :param file_type: could be csv, parquet or tree
+    :param max_workers: number of concurrent downloads, defaults to DOWNLOAD_CONCURRENCY
+    :return: a object list in the order of file_list if input file is csv or parquet, or return a dictionary list if
+             input is tree
+    """
+    try:
+        max_workers = max_workers or DOWNLOAD_CONCURRENCY
+        s3_conn = s3_client(max_pool_connections=max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            objects = list(executor.map(lambda x: read_object(s3_conn, x, file_type), file_list))
 
-        if file_type == ".csv":
-            return object_list
+        if file_type in (".csv", ".parquet"):
+            return objects
         elif file_type == ".tree":
-            return object_dictionary
+            return dict(zip([str(x) for x in file_list], objects))
 
     except Exception as e:
         logging.error("Downloading from S3 file failed. \n" + str(e))
         sys.exit(0)
 
 
+def read_object(s3_conn, s3_path, file_type):
+    """
+    Gets one object through the shared S3 object cache, which only downloads it if it changed, and parses it. Trees
+    are not cached, see s3_cache.UNCACHED_SUFFIXES
+    :param s3_conn: S3 client
+    :param s3_path: key of the object
+    :param file_type: could be csv, parquet or tree
+    :return: a data frame or tree
+    """
+    body, _ = s3_cache.fetch(s3_conn, S3_BUCKET, s3_path)
+    with body:
+        if file_type == ".csv":
+            compression = next((y for x, y in CSV_EXTENSIONS.items() if s3_path.endswith(x)), None)
+            return pd.read_csv(body, dtype=PROJECT_DATA_DTYPES, compression=compression)
+        elif file_type == ".parquet":
+            if pa is None:
+                raise ImportError('pyarrow is not installed, parquet downloads are unavailable')
+            df = pq.read_table(body).to_pandas()
+            return df.astype(dict((x, y) for x, y in PROJECT_DATA_DTYPES.items() if x in df.columns))
+        elif file_type == ".tree":
+            return pickle.load(body)
+        raise ValueError('Unsupported file type ' + str(file_type))
+
+
+def s3_client(max_pool_connections=10):
+    """
+    :param max_pool_connections: size of the connection pool, at least the number of threads sharing the client
+    :return: S3 client
+    """
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_USER,
+                        aws_secret_access_key=decrypted_key, config=Config(max_pool_connections=max_pool_connections))
+
+
 def download_and_merge_project_data_from_s3(num_weeks):
     """
     download project data from s3 and merge them as one file
@@ -181,13 +554,13 @@ def download_and_merge_project_data_from_s3(num_weeks):
     """
     logging.info("Retrieving last " + str(num_weeks) + " weeks of project results from S3")
     try:
-        files_to_download = s3_query(S3_PATH_FOR_DOWNLOADING_project_DATA)
+        files_to_download = s3_query(S3_PATH_FOR_DOWNLOADING_project_DATA, S3_PREFIX_FOR_DOWNLOADING_project_DATA,
+                                     num_weeks)
         files_to_download.sort(reverse=True)
         files_to_download = files_to_download[:num_weeks]
-        downloaded_files = download_object_from_s3(files_to_download, ".csv")
 
-        df = pd.concat(downloaded_files, ignore_index=True)
-        df = df.groupby(['City', 'Day', 'Time'])[['active droids']].sum()
+        # Only the weeks that entered the window since the last run are downloaded and aggregated
+        df = RollingAggregateStore().update(files_to_download)
         df = df.reset_index()
 
         # Don't forget to divide the sum
@@ -199,6 +572,113 @@ def download_and_merge_project_data_from_s3(num_weeks):
         sys.exit(0)
 
 
+class RollingAggregateStore:
+    """
+    Local store of the per week partial sums of the project data and of their running total over the current window
+    of weeks. Updating the window only aggregates the weeks that entered it and subtracts the partials of the weeks
+    that left it, so a run costs one week instead of the whole window. Every group also counts its rows, so groups
+    without rows left in the window are dropped like the full recompute would. Sums of integer counts are exact in
+    any order. Floating point sums depend on the order, so a window holding non integer values is summed from its
+    files like before
+    """
+    def __init__(self, folder=None):
+        self.folder = folder or PROJECT_AGGREGATE_FOLDER
+        self.state_path = os.path.join(self.folder, 'state.json')
+
+    def partial_path(self, s3_path):
+        return os.path.join(self.folder, 'week_' + hashlib.sha1(s3_path.encode('utf-8')).hexdigest() + '.pkl')
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'keys': [], 'integral': {}, 'total': None, 'generation': 0}
+
+    def save_state(self, state):
+        tmp_file = self.state_path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_path)
+
+    def update(self, window):
+        """
+        Moves the window to the given weeks
+        :param window: keys of the weekly project data files in the window
+        :return: data frame of the sums of active droids over the window, indexed by City, Day and Time
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        state = self.load_state()
+        added = [x for x in window if x not in state['keys']]
+        expired = [x for x in state['keys'] if x not in window]
+        missing = [x for x in expired + [y for y in window if y not in added]
+                   if not os.path.exists(self.partial_path(x))]
+        logging.info("Aggregate window: " + str(len(added)) + " new weeks, " + str(len(expired)) + " expired weeks")
+
+        # Aggregate the new weeks, and weeks of the window whose partial was lost
+        downloaded = added + [x for x in missing if x in window]
+        for s3_path, df in zip(downloaded, download_object_from_s3(downloaded, ".csv") if downloaded else []):
+            # Checked on the raw values, fractions can add up to whole numbers in the partial sums
+            state['integral'][s3_path] = bool((df[PROJECT_VALUE_COLUMN] % 1 == 0).all())
+            week_partial(df).to_pickle(self.partial_path(s3_path))
+
+        if not all(state['integral'][x] for x in window):
+            total = week_partial(pd.concat(download_object_from_s3(window, ".csv"), ignore_index=True))
+        elif state['total'] is None or missing or not all(state['integral'].get(x) for x in expired):
+            # Sum the partials of the window again, without downloading them
+            total = sum_partials([pd.read_pickle(self.partial_path(x)) for x in window])
+        else:
+            total = pd.read_pickle(os.path.join(self.folder, state['total']))
+            total = sum_partials([total] + [pd.read_pickle(self.partial_path(x)) for x in added])
+            for s3_path in expired:
+                total = total.sub(pd.read_pickle(self.partial_path(s3_path)), fill_value=0)
+            total = total[total['rows'] > 0].sort_index()
+
+        # The state file is replaced last, a crash before leaves the previous total and state in place
+        old_total = state['total']
+        state['generation'] += 1
+        state['total'] = 'total_%d.pkl' % state['generation']
+        total.to_pickle(os.path.join(self.folder, state['total']))
+        state['keys'] = list(window)
+        for s3_path in expired:
+            state['integral'].pop(s3_path, None)
+        self.save_state(state)
+
+        for path in [os.path.join(self.folder, old_total)] if old_total else []:
+            if os.path.exists(path):
+                os.remove(path)
+        for s3_path in expired:
+            if os.path.exists(self.partial_path(s3_path)):
+                os.remove(self.partial_path(s3_path))
+        return total[[PROJECT_VALUE_COLUMN]]
+
+
+def week_partial(df):
+    """
+    :param df: project data of one week
+    :return: sum of active droids and number of rows of each City, Day and Time group
+    """
+    grouped = df.groupby(PROJECT_GROUP_COLUMNS)
+    partial = grouped[[PROJECT_VALUE_COLUMN]].sum()
+    partial['rows'] = grouped.size()
+    return partial
+
+
+def sum_partials(partials):
+    """
+    :param partials: list of data frames from week_partial
+    :return: sum of the partials over the union of their groups, sorted like a groupby
+    """
+    if not partials:
+        return pd.DataFrame({PROJECT_VALUE_COLUMN: [], 'rows': []},
+                            index=pd.MultiIndex.from_tuples([], names=PROJECT_GROUP_COLUMNS))
+    total = partials[0]
+    for partial in partials[1:]:
+        total = total.add(partial, fill_value=0)
+    return total.sort_index()
+
+
 def run_time(seconds):
     """
     format time to hh:mm:ss
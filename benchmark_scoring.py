@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import io
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import datetime as dt
+import numpy as np
+import pandas as pd
+import scipy
+import utm
+import util
+import s3_cache
+
+from scipy.spatial import cKDTree
+from multiprocessing import cpu_count
+from config import settings
+
+parser = argparse.ArgumentParser(description='benchmark_scoring - Time the KD-tree scoring pipeline on synthetic data')
+parser.add_argument('-a', '--addresses', type=int, default=10000, help='Optional: Number of addresses to score.')
+parser.add_argument('-z', '--zones', type=int, default=3, help='Optional: Number of UTM zones, 1 to 10.')
+parser.add_argument('-p', '--points', type=int, default=100000, help='Optional: Points per zone in every weekly tree.')
+parser.add_argument('-c', '--cities', type=int, default=5, help='Optional: Cities per zone, points cluster around them.')
+parser.add_argument('-s', '--spread', type=float, default=0.1,
+                    help='Optional: Standard deviation in degrees of the points around a city, lower is denser.')
+parser.add_argument('-f', '--format', default='csv', choices=['csv', 'parquet', 'ndjson', 'xlsx'],
+                    help='Optional: Format of the address file.')
+parser.add_argument('-r', '--repeat', type=int, default=3, help='Optional: Times the pipeline is run.')
+parser.add_argument('-w', '--workers', type=int, help='Optional: Query worker processes, defaults to cores - 1.')
+parser.add_argument('--seed', type=int, default=0, help='Optional: Seed of the synthetic data.')
+parser.add_argument('--exact', type=int, default=1, help='Optional: 0 answers zones with density grids.')
+parser.add_argument('-d', '--work_dir', help='Optional: Directory for the local S3 and trees, removed afterwards '
+                                             'unless given.')
+parser.add_argument('-o', '--output', help='Optional: JSON file to write the results to, defaults to stdout.')
+
+# First UTM zone used, zones 10 to 19 cover the continental US
+FIRST_ZONE = 10
+WEEK_DAYS = 7
+
+
+class BenchmarkUtil(util.util):
+    """
+    util reading its trees from a LocalS3Client instead of S3
+    """
+    def __init__(self, s3_root, manifest_file):
+        self.s3_root = s3_root
+        self.S3_MANIFEST_FILE = manifest_file
+
+    def s3_client(self, max_pool_connections=10):
+        return util.LocalS3Client(self.s3_root)
+
+
+class UploadRequest:
+    """
+    Stand-in for the flask request parse_incoming_file reads the address file from
+    """
+    def __init__(self, filename, upload):
+        self.files = {'address_to_score': UploadFile(filename, upload)}
+
+
+class UploadFile:
+    def __init__(self, filename, upload):
+        self.filename = filename
+        self.stream = io.BytesIO(upload)
+
+
+def city_centers(rng, num_zones, num_cities):
+    """
+    :return: array of (zone, latitude, longitude) of every city, inside the continental US
+    """
+    centers = []
+    for zone in range(FIRST_ZONE, FIRST_ZONE + num_zones):
+        central_meridian = zone * 6 - 183
+        for _ in range(num_cities):
+            centers.append((zone, rng.uniform(30, 45), central_meridian + rng.uniform(-2, 2)))
+    return np.array(centers)
+
+
+def clustered_points(rng, centers, num_points, spread):
+    """
+    :return: latitudes and longitudes of points normally distributed around randomly chosen centers
+    """
+    chosen = centers[rng.integers(0, len(centers), num_points)]
+    return chosen[:, 1] + rng.normal(0, spread, num_points), chosen[:, 2] + rng.normal(0, spread, num_points)
+
+
+def generate_trees(rng, centers, args, s3_root, end_day):
+    """
+    Puts pickled weekly trees of every zone into the local S3 bucket, laid out like the real tree partitions
+    :return: total number of points
+    """
+    bucket = os.path.join(s3_root, util.util.S3_BUCKET)
+    total = 0
+    for week in range(settings['util_config']['number_of_weeks']):
+        week_day = end_day - dt.timedelta(days=end_day.weekday() + week * WEEK_DAYS)
+        partition = os.path.join(bucket, util.util.S3_TREE_PREFIX + str(week_day))
+        os.makedirs(partition)
+        for zone in np.unique(centers[:, 0]).astype(int):
+            lat, lon = clustered_points(rng, centers[centers[:, 0] == zone], args.points, args.spread)
+            x, y, _, _ = utm.from_latlon(lat, lon, force_zone_number=zone, force_northern=True)
+            with open(os.path.join(partition, 'PROJECT_%s_utm_%d.tree' % (week_day, zone)), 'wb') as f:
+                pickle.dump(cKDTree(np.column_stack([x, y])), f, protocol=pickle.HIGHEST_PROTOCOL)
+            total += args.points
+    return total
+
+
+def generate_addresses(rng, centers, args):
+    """
+    :return: bytes of an address file in the requested format
+    """
+    lat, lon = clustered_points(rng, centers, args.addresses, args.spread / 2)
+    cities = np.array(['city_%d' % x for x in range(len(centers))])[rng.integers(0, len(centers), args.addresses)]
+    df = pd.DataFrame({'City': cities, 'Latitude': lat, 'Longitude': lon,
+                       'Num_Chargers': rng.integers(0, 10, args.addresses), 'Provider': 'benchmark'})
+    buf = io.BytesIO()
+    if args.format == 'csv':
+        df.to_csv(buf, index=False)
+    elif args.format == 'parquet':
+        df.to_parquet(buf, index=False)
+    elif args.format == 'ndjson':
+        df.to_json(buf, orient='records', lines=True)
+    else:
+        df.to_excel(buf, index=False)
+    return buf.getvalue()
+
+
+def timed(timings, stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+
+def run_pipeline(data, filename, upload, folder, pool, exact, timings):
+    """
+    Scores the address file once, the way the /project resource does
+    """
+    df, input_trees, needed_zones = timed(timings, 'parse', data.parse_incoming_file, UploadRequest(filename, upload))
+
+    # parse already converted the addresses, convert them again on their own to time the UTM stage
+    timed(timings, 'utm', data.calc_utm, df[['latitude', 'longitude']].copy())
+
+    project_trees = timed(timings, 'tree_load', data.load_needed_trees, needed_zones, folder)
+    df = timed(timings, 'query', data.multiprocess_query, df, input_trees, project_trees, pool, False, exact)
+    df = timed(timings, 'score', data.score_locations, df)
+    df = timed(timings, 'rank', data.rank_locations, df)
+    return df
+
+
+def peak_rss_bytes(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def summarize(values):
+    return {'runs': values, 'min': min(values), 'median': float(np.median(values)), 'max': max(values)}
+
+
+def run_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_scoring_')
+    s3_root = os.path.join(work_dir, 's3')
+    tree_root = os.path.join(work_dir, 'trees')
+    for path in (s3_root, tree_root):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    rng = np.random.default_rng(args.seed)
+    end_day = dt.date.today()
+    centers = city_centers(rng, args.zones, args.cities)
+    timings = {}
+    try:
+        start = time.perf_counter()
+        num_points = generate_trees(rng, centers, args, s3_root, end_day)
+        filename = 'addresses.' + args.format
+        upload = generate_addresses(rng, centers, args)
+        generate_seconds = time.perf_counter() - start
+
+        # Keep the S3 object cache in the work directory, so runs neither read nor fill the service's cache
+        s3_cache.cache = s3_cache.S3ObjectCache(os.path.join(work_dir, 's3_cache'))
+        data = BenchmarkUtil(s3_root, os.path.join(work_dir, 's3_manifest.json'))
+        folder = timed(timings, 's3_load', data.publish_snapshot, end_day, tree_root)
+        pool = util.ZoneQueryPool(folder, args.workers)
+        try:
+            for _ in range(args.repeat):
+                run_pipeline(data, filename, upload, folder, pool, bool(args.exact), timings)
+        finally:
+            pool.close()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    pipeline = [sum(x) for x in zip(*[timings[x] for x in ('parse', 'tree_load', 'query', 'score', 'rank')])]
+    return {'parameters': vars(args),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                            'scipy': scipy.__version__, 'cpu_count': cpu_count(), 'platform': platform.platform()},
+            'data': {'addresses': args.addresses, 'upload_bytes': len(upload), 'zones': args.zones,
+                     'weeks': settings['util_config']['number_of_weeks'], 'tree_points': num_points,
+                     'generate_seconds': generate_seconds},
+            'stages': dict((stage, summarize(values)) for stage, values in timings.items()),
+            'pipeline': summarize(pipeline),
+            'addresses_per_second': args.addresses / min(pipeline),
+            'peak_rss_bytes': peak_rss_bytes(resource.RUSAGE_SELF),
+            'peak_worker_rss_bytes': peak_rss_bytes(resource.RUSAGE_CHILDREN)}
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = json.dumps(run_benchmark(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print(results)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import util
+
+from config import settings
+
+parser = argparse.ArgumentParser(description='bulk_score - Score and rank a large address file into partitioned '
+                                             'Parquet, resuming from the last checkpoint after a crash')
+parser.add_argument('-i', '--input', required=True, help='Required: .csv, .parquet, .ndjson or .jsonl address file.')
+parser.add_argument('-o', '--output', required=True, help='Required: Directory of the Parquet dataset, partitioned '
+                                                          'by city.')
+parser.add_argument('-d', '--work_dir', help='Optional: Directory of the checkpoint and intermediate counts, '
+                                             'defaults to <output>.work')
+parser.add_argument('-c', '--chunk_rows', type=int, default=util.util.INPUT_CHUNK_ROWS,
+                    help='Optional: Rows per chunk, bounds the memory used.')
+parser.add_argument('-w', '--workers', type=int, help='Optional: Query worker processes, defaults to cores - 1.')
+parser.add_argument('-t', '--tree_folder', help='Optional: Folder of the trees, defaults to the current snapshot.')
+parser.add_argument('--exact', type=int, default=1, help='Optional: 0 answers zones with density grids.')
+parser.add_argument('--restart', action='store_true', help='Optional: Ignore the checkpoint and start over.')
+
+CHECKPOINT_FILE = 'checkpoint.json'
+COUNTS_FOLDER = 'counts'
+
+# Phases of a run, each one goes over every chunk
+QUERY, SCORE, RANK, DONE = 'query', 'score', 'rank', 'done'
+
+
+class BulkScoreException(Exception):
+    pass
+
+
+class BulkScorer:
+    """
+    Scores an address file in three passes over chunks of chunk_rows rows, so memory stays bounded whatever the
+    size of the file:
+    query: converts each chunk to UTM, counts the points around it and keeps the counts in the work directory,
+           along with the per city maxima scores are relative to
+    score: scores every chunk against the maxima of the whole file to find the per city score ranges
+    rank:  scores and ranks every chunk against those ranges and writes it to the Parquet dataset
+    The checkpoint is saved after every chunk, a restarted run continues after the last completed one
+    """
+    def __init__(self, input_path, output, work_dir=None, chunk_rows=util.util.INPUT_CHUNK_ROWS, workers=None,
+                 tree_folder=None, exact=True):
+        self.data = util.util()
+        self.input_path = input_path
+        self.output = output
+        self.work_dir = work_dir or output.rstrip(os.sep) + '.work'
+        self.chunk_rows = chunk_rows
+        self.workers = workers
+        self.exact = exact
+        self.tree_folder = tree_folder or self.data.current_snapshot() or \
+            settings['directories']['current_tree_folder']
+        self.checkpoint_path = os.path.join(self.work_dir, CHECKPOINT_FILE)
+
+    def new_checkpoint(self):
+        stat = os.stat(self.input_path)
+        return {'input': os.path.abspath(self.input_path), 'input_size': stat.st_size,
+                'input_mtime': stat.st_mtime_ns, 'chunk_rows': self.chunk_rows,
+                'tree_folder': os.path.abspath(self.tree_folder), 'phase': QUERY, 'chunks': 0, 'next_chunk': 0,
+                'rows': 0, 'maxima': None, 'score_range': None}
+
+    def load_checkpoint(self, restart=False):
+        """
+        :param restart: Discard the checkpoint and counts of a previous run
+        :return: checkpoint dictionary, a new one if there is none
+        """
+        if restart:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        if not os.path.exists(self.checkpoint_path):
+            if os.path.isdir(self.output) and os.listdir(self.output):
+                raise BulkScoreException('Output directory ' + self.output + ' is not empty')
+            os.makedirs(os.path.join(self.work_dir, COUNTS_FOLDER), exist_ok=True)
+            return self.new_checkpoint()
+
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        expected = self.new_checkpoint()
+        for key in ['input', 'input_size', 'input_mtime', 'chunk_rows', 'tree_folder']:
+            if checkpoint[key] != expected[key]:
+                raise BulkScoreException('Checkpoint was made with a different ' + key + ', run with --restart')
+        logging.info('Resuming ' + checkpoint['phase'] + ' at chunk ' + str(checkpoint['next_chunk']))
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        tmp_file = self.checkpoint_path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, self.checkpoint_path)
+
+    def counts_path(self, chunk):
+        return os.path.join(self.work_dir, COUNTS_FOLDER, 'part-%06d.pkl' % chunk)
+
+    def run(self, restart=False):
+        """
+        Runs the remaining phases
+        :param restart: Discard the checkpoint and counts of a previous run
+        :return: number of rows scored
+        """
+        if not os.path.isdir(self.tree_folder):
+            raise BulkScoreException('Tree folder ' + self.tree_folder + ' no longer exists, run with --restart')
+
+        checkpoint = self.load_checkpoint(restart)
+        if checkpoint['phase'] == QUERY:
+            self.query(checkpoint)
+        if checkpoint['phase'] == SCORE:
+            self.score(checkpoint)
+        if checkpoint['phase'] == RANK:
+            self.rank(checkpoint)
+        shutil.rmtree(os.path.join(self.work_dir, COUNTS_FOLDER), ignore_errors=True)
+        return checkpoint['rows']
+
+    def next_phase(self, checkpoint, phase):
+        checkpoint['phase'] = phase
+        checkpoint['next_chunk'] = 0
+        self.save_checkpoint(checkpoint)
+
+    def query(self, checkpoint):
+        """
+        Counts the points around every chunk of the input, keeping the counts and the running per city maxima
+        """
+        maxima = frame_from_json(checkpoint['maxima'])
+        pool = util.ZoneQueryPool(self.tree_folder, self.workers)
+        listings = util.FolderListingCache()
+        try:
+            with open(self.input_path, 'rb') as stream:
+                for chunk, df in enumerate(util.read_input_chunks(self.input_path, stream, self.chunk_rows)):
+                    # Chunks before the checkpoint are read again but not queried
+                    if chunk < checkpoint['next_chunk']:
+                        continue
+                    df = self.data.prepare_input(df)
+                    input_trees = dict((str(x), None) for x in df.z.unique())
+                    project_trees = self.data.load_needed_trees(df.z.unique(), self.tree_folder, listings)
+                    df = self.data.multiprocess_query(df, input_trees, project_trees, pool, exact=self.exact)
+                    df.to_pickle(self.counts_path(chunk))
+
+                    chunk_maxima = util.city_maxima(df)
+                    maxima = chunk_maxima if maxima is None else \
+                        pd.concat([maxima, chunk_maxima]).groupby(level=0).max()
+                    checkpoint.update(maxima=frame_to_json(maxima), next_chunk=chunk + 1, chunks=chunk + 1,
+                                      rows=checkpoint['rows'] + len(df))
+                    self.save_checkpoint(checkpoint)
+                    logging.info('Queried chunk ' + str(chunk) + ', ' + str(checkpoint['rows']) + ' rows')
+        finally:
+            pool.close()
+        self.next_phase(checkpoint, SCORE)
+
+    def score(self, checkpoint):
+        """
+        Scores every chunk against the maxima of the whole input to find the per city score ranges
+        """
+        maxima = frame_from_json(checkpoint['maxima'])
+        score_range = frame_from_json(checkpoint['score_range'])
+        for chunk in range(checkpoint['next_chunk'], checkpoint['chunks']):
+            df = self.data.score_locations(pd.read_pickle(self.counts_path(chunk)), maxima=maxima)
+            chunk_range = util.city_score_range(df)
+            score_range = chunk_range if score_range is None else \
+                pd.concat([score_range, chunk_range]).groupby(level=0).agg({'min': 'min', 'max': 'max'})
+            checkpoint.update(score_range=frame_to_json(score_range), next_chunk=chunk + 1)
+            self.save_checkpoint(checkpoint)
+        self.next_phase(checkpoint, RANK)
+
+    def rank(self, checkpoint):
+        """
+        Scores and ranks every chunk against the ranges of the whole input and adds it to the Parquet dataset. A
+        chunk written again after a crash replaces its previous files
+        """
+        maxima = frame_from_json(checkpoint['maxima'])
+        score_range = frame_from_json(checkpoint['score_range'])
+        for chunk in range(checkpoint['next_chunk'], checkpoint['chunks']):
+            df = self.data.score_locations(pd.read_pickle(self.counts_path(chunk)), maxima=maxima)
+            df = self.data.rank_locations(df, score_range=score_range)
+            write_partitions(df, self.output, chunk)
+            checkpoint['next_chunk'] = chunk + 1
+            self.save_checkpoint(checkpoint)
+            logging.info('Wrote chunk ' + str(chunk))
+        self.next_phase(checkpoint, DONE)
+
+
+def write_partitions(df, output, chunk):
+    """
+    Writes a ranked chunk to the dataset, one file per city under city=<name> folders
+    :param df: Scored and ranked data frame
+    :param output: Directory of the dataset
+    :param chunk: Number of the chunk, part of the file names
+    """
+    # Parquet has real nulls, use them instead of the -1 and 'N/A' placeholders
+    no_chargers = df['num_chargers'] == -1
+    df['num_chargers'] = df['num_chargers'].where(~no_chargers).astype(float)
+    df['score_chargers'] = df['score_chargers'].where(~no_chargers).astype(float)
+    for column in df.columns:
+        if column != 'city' and df[column].dtype == object:
+            df[column] = df[column].astype(str)
+
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), output, partition_cols=['city'],
+                        basename_template='part-%06d-{i}.parquet' % chunk,
+                        existing_data_behavior='overwrite_or_ignore')
+
+
+def frame_to_json(df):
+    return None if df is None else df.to_dict('split')
+
+
+def frame_from_json(value):
+    return None if value is None else pd.DataFrame(value['data'], index=value['index'], columns=value['columns'])
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    scorer = BulkScorer(args.input, args.output, args.work_dir, args.chunk_rows, args.workers, args.tree_folder,
+                        bool(args.exact))
+    print('Scored ' + str(scorer.run(args.restart)) + ' rows into ' + args.output)
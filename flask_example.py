@@ -1,7 +1,18 @@
 #!/usr/bin/env python
 
+import io
+import os
 import util
+import metrics
+import zone_shard
+import logging
+import pandas as pd
+import threading
+import time
+import uuid
 import werkzeug
+from collections import OrderedDict
+from concurrent import futures
 from flask import Flask, Response, json
 from flask_restplus import reqparse, Api, Resource, abort
 from flask_restful import request
@@ -9,6 +20,12 @@ from config import settings
 from util import MissingColumnException, InvalidDateFormatException
 from flask_cors import CORS
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 app = Flask(__name__)
 CORS(app)
 
@@ -16,41 +33,360 @@ api = Api(app)
 data = util.util()
 data.start_log()
 
-all_trees = data.s3_load_trees()
+# Trees are read from the published snapshot, /update builds and publishes new ones in the background
+data.publish_snapshot()
+update_executor = futures.ThreadPoolExecutor(max_workers=1)
+
+# Long lived query workers, started once so every request reuses their loaded trees. With zone_shards set, the
+# queries are routed to zone_shard workers holding the trees of their zones instead
+ZONE_SHARDS = settings['util_config'].get('zone_shards')
+if ZONE_SHARDS:
+    query_pool = zone_shard.ShardRouter([zone_shard.parse_address(x) for x in ZONE_SHARDS])
+else:
+    query_pool = util.ZoneQueryPool(data.current_snapshot())
+
+# Listings of the snapshot folders, the trees themselves are cached inside the query workers
+folder_listings = util.FolderListingCache()
+
+# Radius counts of recently scored addresses, dropped whenever a new snapshot is published
+result_cache = util.ResultCache()
+
+# Uploads larger than this are scored as background jobs, at most MAX_CONCURRENT_JOBS run at once
+ASYNC_UPLOAD_BYTES = settings['util_config'].get('async_upload_bytes', 2 ** 20)
+MAX_CONCURRENT_JOBS = settings['util_config'].get('max_concurrent_jobs', 2)
+MAX_PENDING_JOBS = settings['util_config'].get('max_pending_jobs', 20)
+JOB_TTL = settings['util_config'].get('job_ttl_seconds', 3600)
+MAX_JOB_WAIT = 60
+job_executor = futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Metrics exposed on /metrics, the stage histograms are shared with util
+stage_seconds = metrics.STAGE_SECONDS
+if not ZONE_SHARDS:
+    metrics.register(metrics.Gauge('tree_cache_hits_total', 'Trees found in the tree caches of the query workers',
+                                   lambda: query_pool.tree_cache_stats()['hits'], 'counter'))
+    metrics.register(metrics.Gauge('tree_cache_misses_total', 'Trees loaded from disk by the query workers',
+                                   lambda: query_pool.tree_cache_stats()['misses'], 'counter'))
+metrics.register(metrics.Gauge('result_cache_hits_total', 'Addresses found in the result cache',
+                               lambda: result_cache.stats()['hits'], 'counter'))
+metrics.register(metrics.Gauge('result_cache_misses_total', 'Addresses queried against the trees',
+                               lambda: result_cache.stats()['misses'], 'counter'))
+metrics.register(metrics.Gauge('query_pool_queue_depth', 'Tree queries waiting for or running in a worker',
+                               query_pool.queue_depth))
+
 parser = reqparse.RequestParser()
 parser.add_argument('address_to_score', type=werkzeug.datastructures.FileStorage, location='files')
 
 
+def score_upload(filename, upload, per_week=False, exact=True):
+    """
+    Runs the scoring pipeline on an uploaded file
+    :param filename: name of the uploaded file
+    :param upload: bytes of the uploaded file
+    :param per_week: Add per week count columns
+    :param exact: Query the trees even for zones that have a density grid
+    :return: Data frame of scored and ranked locations
+    """
+    # Resolve the snapshot once, an update published while scoring does not affect this upload
+    folder = data.current_snapshot()
+    with stage_seconds.time('parse'):
+        df, input_trees, needed_zones = data.parse_upload(filename, upload)
+
+    with stage_seconds.time('tree_load'):
+        if ZONE_SHARDS:
+            project_trees = query_pool.needed_trees(needed_zones)
+            version = query_pool.version
+        else:
+            project_trees = data.load_needed_trees(needed_zones, folder, folder_listings, per_week)
+            version = os.path.basename(folder)
+            logging.info('Tree cache: ' + str(query_pool.tree_cache_stats()))
+
+    with stage_seconds.time('query'):
+        df = data.multiprocess_query(df, input_trees, project_trees, query_pool, per_week, exact, result_cache,
+                                     version)
+    logging.info('Result cache: ' + str(result_cache.stats()))
+    with stage_seconds.time('score'):
+        df = data.score_locations(df)
+    with stage_seconds.time('rank'):
+        df = data.rank_locations(df)
+    return data.replace_null(df)
+
+
+def scores_response(df):
+    """
+    Serializes scored locations in the format negotiated with the Accept header. JSON is built in one piece as
+    before, every other format is streamed to the client in chunks of STREAM_CHUNK_ROWS rows
+    :param df: Data frame of scored and ranked locations
+    :return: Response
+    """
+    mimetype = request.accept_mimetypes.best_match(list(RESPONSE_FORMATS), default='application/json')
+    if mimetype == 'application/json':
+        with stage_seconds.time('serialize'):
+            resp = Response(json.dumps(df.to_dict('index')), mimetype=mimetype)
+    elif mimetype in ARROW_FORMATS and pa is None:
+        abort(406, 'pyarrow is not installed, Arrow and Parquet responses are unavailable')
+    else:
+        resp = Response(timed_chunks(RESPONSE_FORMATS[mimetype](df)), mimetype=mimetype)
+    resp.status_code = 200
+    return resp
+
+
+def timed_chunks(chunks):
+    """
+    Observes the time spent serializing a streamed response, without the time spent sending it
+    :param chunks: generator of serialized chunks
+    :return: generator of the same chunks
+    """
+    elapsed = 0.
+    start = time.perf_counter()
+    for chunk in chunks:
+        elapsed += time.perf_counter() - start
+        yield chunk
+        start = time.perf_counter()
+    stage_seconds.observe(elapsed + time.perf_counter() - start, 'serialize')
+
+
+def row_chunks(df):
+    """
+    :param df: Data frame to split
+    :return: generator of consecutive row slices, at least one even if the frame is empty
+    """
+    for start in range(0, max(len(df), 1), STREAM_CHUNK_ROWS):
+        yield df.iloc[start:start + STREAM_CHUNK_ROWS]
+
+
+def ndjson_chunks(df):
+    for chunk in row_chunks(df):
+        if len(chunk):
+            lines = chunk.to_json(orient='records', lines=True)
+            yield lines if lines.endswith('\n') else lines + '\n'
+
+
+def csv_chunks(df):
+    for i, chunk in enumerate(row_chunks(df)):
+        yield chunk.to_csv(header=i == 0, index=False)
+
+
+def arrow_chunks(df):
+    sink = ChunkSink()
+    writer = None
+    schema = None
+    for chunk in row_chunks(df):
+        batch = pa.RecordBatch.from_pandas(typed_columns(chunk), schema=schema, preserve_index=False)
+        if writer is None:
+            schema = batch.schema
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_chunks(df):
+    sink = ChunkSink()
+    writer = None
+    schema = None
+    for chunk in row_chunks(df):
+        table = pa.Table.from_pandas(typed_columns(chunk), schema=schema, preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            writer = pq.ParquetWriter(sink, schema)
+
+        # Every chunk is a row group, its bytes can be sent before the next one is serialized
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def typed_columns(chunk):
+    """
+    Columnar formats have real nulls, turn the 'N/A' placeholders of replace_null back into numeric nulls. Every other
+    object column is written as strings, pyarrow refuses columns mixing strings with numbers
+    :param chunk: Data frame slice
+    :return: Data frame slice with numeric charger columns and string object columns
+    """
+    chunk = chunk.copy()
+    for column in chunk.columns:
+        if chunk[column].dtype != object:
+            continue
+        if column in ['num_chargers', 'score_chargers']:
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce').astype(float)
+        else:
+            chunk[column] = chunk[column].astype(str)
+    return chunk
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write only file object collecting the bytes written by pyarrow until they are drained into the response
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Response formats by mimetype, all but JSON are streamed in chunks
+STREAM_CHUNK_ROWS = settings['util_config'].get('stream_chunk_rows', 10000)
+RESPONSE_FORMATS = OrderedDict([
+    ('application/json', None),
+    ('application/x-ndjson', ndjson_chunks),
+    ('text/csv', csv_chunks),
+    ('application/vnd.apache.arrow.stream', arrow_chunks),
+    ('application/vnd.apache.parquet', parquet_chunks)])
+ARROW_FORMATS = ['application/vnd.apache.arrow.stream', 'application/vnd.apache.parquet']
+
+
+def purge_jobs(now):
+    """
+    Forgets finished jobs nobody collected before they expired, the caller holds jobs_lock
+    :param now: current time
+    """
+    for job_id in [x for x, job in jobs.items() if job['expires'] < now and job['future'].done()]:
+        del jobs[job_id]
+
+
+def submit_job(filename, upload, per_week, exact):
+    """
+    Queues the scoring of an upload on the job executor
+    :return: job id
+    """
+    with jobs_lock:
+        now = time.time()
+        purge_jobs(now)
+
+        if len([job for job in jobs.values() if not job['future'].done()]) >= MAX_PENDING_JOBS:
+            abort(503, 'Too many scoring jobs in progress, retry later')
+
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {'future': job_executor.submit(score_upload, filename, upload, per_week, exact),
+                        'expires': now + JOB_TTL}
+    return job_id
+
+
+def job_response(job_id):
+    resp = Response(json.dumps({'job_id': job_id, 'status': 'running', 'result': api.url_for(projectJob, job_id=job_id)}),
+                    mimetype='application/json')
+    resp.status_code = 202
+    return resp
+
+
+def read_upload():
+    """
+    Reads the uploaded file and the scoring options of the current request
+    :return: filename, bytes of the upload, per_week, exact
+    """
+    if 'address_to_score' not in request.files:
+        abort(400, 'Missing address_to_score file')
+    upload = request.files['address_to_score']
+
+    # Teams that need per week counts ask for them with ?per_week=true, everyone else queries the merged trees
+    per_week = request.args.get('per_week', 'false').lower() == 'true'
+    if per_week and ZONE_SHARDS:
+        # Zone shards only hold the merged tree of a zone when there is one, not its weekly trees
+        abort(400, 'per_week is not available when the trees are served by zone shards')
+
+    # ?exact=false answers zones that have a density grid from the grid instead of the trees
+    exact = request.args.get('exact', 'true').lower() == 'true'
+    return upload.filename, upload.stream.read(), per_week, exact
+
+
 @api.route('/project')
 class project(Resource):
 
     @api.expect(parser)
     @api.response(200, 'Success')
+    @api.response(202, 'Large upload, scoring continues as a job')
     @api.response(400, 'Validation Error')
     def post(self):
         """
         Takes in an excel file of addresses and outputs a JSON with scores and rankings.
+        Large files are scored in the background, the response then holds the job id to poll.
         """
+        filename, upload, per_week, exact = read_upload()
+        if len(upload) > ASYNC_UPLOAD_BYTES:
+            return job_response(submit_job(filename, upload, per_week, exact))
+
         try:
-            df, input_trees, needed_zones = data.parse_incoming_file(request)
+            df = score_upload(filename, upload, per_week, exact)
 
         except MissingColumnException as e:
-            abort(400, 'Excel File Missing Mandatory Column(s):', columns=str(e))
+            abort(400, 'Input File Missing Mandatory Column(s):', columns=str(e))
 
         except Exception as e:
             abort(400, str(e))
 
-        project_trees = data.load_needed_trees(needed_zones, settings['directories']['current_tree_folder'])
+        return scores_response(df)
 
-        df = data.multiprocess_query(df, input_trees, project_trees)
-        df = data.score_locations(df)
-        df = data.rank_locations(df)
-        df = data.replace_null(df)
-        output_file = df.to_dict('index')
-        resp = Response(json.dumps(output_file), mimetype='application/json')
-        resp.status_code = 200
 
-        return resp
+@api.route('/project/jobs')
+class projectJobs(Resource):
+
+    @api.expect(parser)
+    @api.response(202, 'Job submitted')
+    @api.response(503, 'Too many jobs in progress')
+    def post(self):
+        """
+        Takes in an excel file of addresses and scores it in the background. Returns the job id to poll.
+        """
+        return job_response(submit_job(*read_upload()))
+
+
+@api.route('/project/jobs/<string:job_id>')
+class projectJob(Resource):
+
+    @api.response(200, 'Success')
+    @api.response(202, 'Job still running')
+    @api.response(400, 'Validation Error')
+    @api.response(404, 'Unknown job')
+    def get(self, job_id):
+        """
+        Returns the scores and rankings of a job. ?wait=<seconds> waits up to that long for the job to finish.
+        """
+        with jobs_lock:
+            purge_jobs(time.time())
+            job = jobs.get(job_id)
+        if job is None:
+            abort(404, 'Unknown job ' + job_id)
+
+        try:
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            wait = None
+        if wait is None or not wait >= 0:
+            abort(400, 'wait has to be a number of seconds')
+        wait = min(wait, MAX_JOB_WAIT)
+        futures.wait([job['future']], timeout=wait)
+        if not job['future'].done():
+            return job_response(job_id)
+
+        try:
+            df = job['future'].result()
+
+        except MissingColumnException as e:
+            abort(400, 'Input File Missing Mandatory Column(s):', columns=str(e))
+
+        except Exception as e:
+            abort(400, str(e))
+
+        return scores_response(df)
 
 
 @api.route('/project/health')
@@ -67,29 +403,54 @@ class projectHealth(Resource):
         return resp
 
 
+@api.route('/metrics')
+class Metrics(Resource):
+
+    @api.response(200, 'Success')
+    def get(self):
+        """
+        Returns the stage latencies, cache statistics and resource usage of the service in the Prometheus text format.
+        """
+        resp = Response(metrics.generate_latest(), content_type=metrics.CONTENT_TYPE)
+        resp.status_code = 200
+
+        return resp
+
+
 @api.route('/update/<string:date>', endpoint='update')
 class UpdateData(Resource):
 
-    @api.response(200, 'Success')
+    @api.response(202, 'Update started')
     @api.response(400, 'Input Error')
     def post(self, date=None):
         """
-        Performs the updates to the tree data used to score the inputted addresses.
+        Builds a new snapshot of the tree data used to score the inputted addresses in the background and publishes
+        it once complete. Requests already running finish on the previous snapshot.
         """
         try:
-            data.s3_load_trees(end_day=date)
+            end_day = util.parse_end_day(date)
         except InvalidDateFormatException:
             abort(400, 'Invalid Date format. Date has to be entered in yyyy-mm-dd format')
 
-        resp = Response(json.dumps('Success'), mimetype='application/json')
-        resp.status_code = 200
+        update_executor.submit(data.publish_snapshot, end_day).add_done_callback(log_update)
+
+        resp = Response(json.dumps('Update started'), mimetype='application/json')
+        resp.status_code = 202
 
         return resp
 
 
+def log_update(future):
+    if future.exception() is not None:
+        logging.error('Tree update failed: ' + str(future.exception()))
+
+
 # Actually setup the Api resource routing here
 api.add_resource(project, '/project')
 api.add_resource(projectHealth, '/project/health')
+api.add_resource(projectJobs, '/project/jobs')
+api.add_resource(projectJob, '/project/jobs/<string:job_id>')
+api.add_resource(Metrics, '/metrics')
 api.add_resource(UpdateData, '/update')
 
 
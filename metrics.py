@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import resource
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram:
+    """
+    Prometheus histogram with one series per value of an optional label. Observing a value takes a lock and
+    increments one bucket, buckets are only made cumulative when the metrics are exposed
+    """
+    def __init__(self, name, documentation, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, label_value=None):
+        """
+        Observes the duration of the with block
+        :param label_value: value of the label of the series to observe
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label_value)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((k, list(v[0]), v[1], v[2]) for k, v in self.series.items())
+        for label_value, counts, total, count in series:
+            labels = '' if label_value is None else '%s="%s",' % (self.label, label_value)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, labels, le, cumulative))
+            labels = '{%s}' % labels[:-1] if labels else ''
+            lines.append('%s_sum%s %r' % (self.name, labels, total))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Counter:
+    """
+    Monotonic Prometheus counter
+    """
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def expose(self):
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name,
+                '%s %r' % (self.name, self.value)]
+
+
+class Gauge:
+    """
+    Metric read from a function when the metrics are exposed, so values that are already tracked elsewhere, like
+    cache statistics, cost nothing between scrapes
+    """
+    def __init__(self, name, documentation, function, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.metric_type = metric_type
+
+    def expose(self):
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type),
+                '%s %r' % (self.name, self.function())]
+
+
+def register(metric):
+    """
+    Adds a metric to the ones exposed by generate_latest
+    :param metric: Histogram, Counter or Gauge
+    :return: the metric
+    """
+    with registry_lock:
+        registry.append(metric)
+    return metric
+
+
+def generate_latest():
+    """
+    :return: Every registered metric in the Prometheus text format
+    """
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def process_rss_bytes():
+    """
+    :return: Resident memory of this process, the peak resident memory where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+registry = []
+registry_lock = threading.Lock()
+
+STAGE_SECONDS = register(Histogram('project_stage_seconds', 'Time spent in each stage of scoring an upload', 'stage'))
+S3_DOWNLOAD_BYTES = register(Counter('s3_download_bytes_total', 'Bytes downloaded from S3 by s3_download'))
+register(Gauge('process_resident_memory_bytes', 'Resident memory size in bytes', process_rss_bytes))
@@ -3,19 +3,37 @@
 import io
 import os
 import boto3
+import numpy as np
 import pandas as pd
 import logging
 import pickle
+import re
+import json
+import shutil
+import scipy
 import utm
 import datetime as dt
 import time
+import threading
+import tempfile
+import metrics
+import s3_cache
 
 from os import listdir
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from config import settings
 from scipy.spatial import cKDTree
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Array, Pool, cpu_count
 from crypto import security
 
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
 
 class util:
     S3_USER = settings['S3_info']['S3_USER']
@@ -24,8 +42,47 @@ class util:
     S3_ENDPOINT = settings['S3_info']['S3_ENDPOINT']
     LOG_FILE_PATH = settings['directories']['Log_file_path']
 
+    # Prefix holding the weekly date partitions of the trees, and the local cache of their listings
+    S3_TREE_PREFIX = settings['S3_info'].get('S3_TREE_PREFIX', '')
+    S3_MANIFEST_FILE = settings['directories'].get('s3_manifest_file', os.path.join(
+        os.path.dirname(os.path.abspath(settings['directories']['current_tree_folder'])), 's3_manifest.json'))
+
     PROXIMITY_RADII = [200, 400, 800, 1600]  # Meters
 
+    # Columns every uploaded file must have and the dtypes they are parsed with
+    INPUT_DTYPES = OrderedDict([('city', object), ('latitude', 'float64'), ('longitude', 'float64'),
+                                ('num_chargers', 'float64'), ('provider', object)])
+
+    # Upload formats parsed in chunks of INPUT_CHUNK_ROWS rows
+    CHUNKED_FORMATS = ('.csv', '.parquet', '.ndjson', '.jsonl')
+    INPUT_CHUNK_ROWS = settings['util_config'].get('input_chunk_rows', 100000)
+
+    # Ranking labels from lowest to highest, one per category
+    RANKING_LABELS = settings['util_config'].get('ranking_labels', ['Lowest', 'Low', 'Mid', 'High', 'Highest'])
+
+    # Weight of each count column in each score, can be overridden in the util_config settings
+    SCORE_WEIGHTS = settings['util_config'].get('score_weights', {
+        'score_nochargers': {'num_pts200': 0.4, 'num_pts400': 0.3, 'num_pts800': 0.2, 'num_pts1600': 0.1},
+        'score_chargers': {'num_pts200': 0.25, 'num_pts400': 0.2, 'num_pts800': 0.15, 'num_pts1600': 0.1,
+                           'num_chargers': 0.3}})
+    TREE_FORMAT_VERSION = 1
+    MERGED_TREE_FOLDER = 'merged'
+
+    # Tree snapshots live in <current_tree_folder>/snapshots, the current one is the target of the current symlink
+    SNAPSHOT_FOLDER = 'snapshots'
+    CURRENT_SNAPSHOT_LINK = 'current'
+    SNAPSHOTS_KEPT = settings['util_config'].get('tree_snapshots_kept', 3)
+
+    # Concurrent S3 downloads, retries per file and base backoff in seconds
+    DOWNLOAD_CONCURRENCY = settings['util_config'].get('download_concurrency', 8)
+    DOWNLOAD_RETRIES = settings['util_config'].get('download_retries', 3)
+    DOWNLOAD_BACKOFF = settings['util_config'].get('download_backoff', 0.5)
+    DOWNLOAD_CHUNK_SIZE = 2 ** 20
+
+    # Cell size in meters of the density grids built next to the merged trees, grids are not built if None
+    DENSITY_GRID_CELL_SIZE = settings['util_config'].get('density_grid_cell_m')
+    DENSITY_GRID_MAX_CELLS = settings['util_config'].get('density_grid_max_cells', 50000000)
+
     crypt = security.PasswordHash
     key = os.environ['PROJECT_KEY']
     secure = crypt(key)
@@ -55,13 +112,7 @@ class util:
         :return: Dictionary of file path and actual tree file
         """
 
-        try:
-            if isinstance(end_day, str):
-                end_day = dt.datetime.strptime(end_day, '%Y-%m-%d').date()
-            elif end_day is None:
-                end_day = dt.date.today()
-        except ValueError:
-            raise InvalidDateFormatException
+        end_day = parse_end_day(end_day)
         logging.info('Update End Day: ' + str(end_day))
 
         weekday = end_day.weekday()
@@ -70,17 +121,15 @@ class util:
         logging.info('Update Start day: ' + str(start_week))
 
         logging.info('Loading spatial trees into memory from S3')
-        file_list = self.s3_query('.tree')
-
-        dir_names = []
-        for item in file_list:
-            if item[:1] != '/':
-                dir_names.append(os.path.dirname(item))
-        dir_names = list(sorted(set(dir_names), reverse=True))
+        s3_conn = self.s3_client()
+        dir_names = list(sorted(self.s3_list_partitions(s3_conn), reverse=True))
 
         # get list of weeks to add, list of weeks to remove based on date
         needed_weeks, obsolete_weeks = evaluate_dates(dir_names, start_week, end_day)
 
+        # only list the files of the needed weeks
+        file_list = self.s3_query('.tree', needed_weeks, s3_conn)
+
         # get all tree files under needed weeks in s3
         all_files = get_all_files(file_list, dir_names)
 
@@ -95,7 +144,7 @@ class util:
             os.mkdir(folder)
         except OSError:
             pass
-        tree_folder = [f for f in listdir(os.path.join(folder, os.path.curdir))]
+        tree_folder = [f for f in listdir(os.path.join(folder, os.path.curdir)) if f != self.MERGED_TREE_FOLDER]
 
         # remove items already in disk from files to download list
         files_to_download = filter_download_list(files_to_download, tree_folder)
@@ -106,31 +155,119 @@ class util:
 
         downloaded_files = self.s3_download(files_to_download, '.tree', folder)
         logging.info(downloaded_files)
+
+        # merge the weeks of each zone so requests only query one tree per zone
+        merged_files = build_merged_trees(folder)
+        logging.info('Merged trees rebuilt: ' + str(merged_files))
+
+        # optional density grids for approximate, constant time proximity counts
+        if self.DENSITY_GRID_CELL_SIZE:
+            grid_files = build_density_grids(folder, self.DENSITY_GRID_CELL_SIZE)
+            logging.info('Density grids rebuilt: ' + str(grid_files))
         return downloaded_files
 
+    def current_snapshot(self, root=settings['directories']['current_tree_folder']):
+        """
+        Resolves the published tree snapshot. Callers should resolve it once per request and use the returned folder
+        throughout, so a snapshot published in the meantime does not change the trees under them
+        :param root: The folder holding the snapshots
+        :return: folder of the current snapshot, None if no snapshot was published yet
+        """
+        try:
+            return os.path.join(root, os.readlink(os.path.join(root, self.CURRENT_SNAPSHOT_LINK)))
+        except OSError:
+            return None
+
+    def publish_snapshot(self, end_day=None, root=settings['directories']['current_tree_folder']):
+        """
+        Builds a new tree snapshot and publishes it by atomically replacing the current snapshot symlink. The new
+        snapshot starts as hard links of the current one, so only new weeks are downloaded and files that requests
+        are reading are never modified or deleted in place
+        :param end_day: The day to start loading 13 weeks of data from
+        :param root: The folder holding the snapshots
+        :return: folder of the published snapshot
+        """
+        end_day = parse_end_day(end_day)
+        version = dt.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        folder = os.path.join(root, self.SNAPSHOT_FOLDER, version)
+        os.makedirs(folder)
+
+        try:
+            # trees of the current snapshot, or of the flat folder layout used before snapshots
+            link_trees(self.current_snapshot(root) or root, folder)
+            self.s3_load_trees(folder, end_day)
+        except Exception:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+
+        tmp_link = os.path.join(root, self.CURRENT_SNAPSHOT_LINK + '.tmp')
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join(self.SNAPSHOT_FOLDER, version), tmp_link)
+        os.replace(tmp_link, os.path.join(root, self.CURRENT_SNAPSHOT_LINK))
+        logging.info('Published tree snapshot ' + version)
+
+        # Keep a few previous snapshots for requests that resolved them before the swap
+        snapshots = sorted(os.listdir(os.path.join(root, self.SNAPSHOT_FOLDER)), reverse=True)
+        for old_version in snapshots[self.SNAPSHOTS_KEPT:]:
+            logging.info('Removing tree snapshot ' + old_version)
+            shutil.rmtree(os.path.join(root, self.SNAPSHOT_FOLDER, old_version), ignore_errors=True)
+        return folder
+
     def parse_incoming_file(self, request):
         """
-        Parses and validates input excel file and then returns information about which tree file to load
-        :param request: http request containing the .xlsx file containing addresses to score
-        :return: df: Data frame of excel sheet, input_trees: Dictionary mapping utm zone to tree, needed_zones: UTM zones needed to calculate scores
+        Parses and validates the input file and then returns information about which tree file to load
+        :param request: http request containing the .xlsx, .csv, .parquet or .ndjson file of addresses to score
+        :return: df: Data frame of the uploaded file, input_trees: Dictionary mapping utm zone to None, needed_zones: UTM zones needed to calculate scores
+        """
+        upload = request.files['address_to_score']
+        return self.parse_upload(upload.filename, upload.stream.read())
+
+    def parse_upload(self, filename, upload):
+        """
+        Parses and validates an uploaded file, used by parse_incoming_file and by jobs running outside of the request
+        :param filename: name of the uploaded file, .xlsx, .csv, .parquet, .ndjson or .jsonl
+        :param upload: bytes of the uploaded file
+        :return: df: Data frame of the uploaded file, input_trees: Dictionary mapping utm zone to None, needed_zones: UTM zones needed to calculate scores
         """
         # Determine file type
-        if '.xlsx' in request.files['address_to_score'].filename:
-            xlsx_stream = request.files['address_to_score'].stream.read()
-            df = pd.read_excel(io.BytesIO(xlsx_stream))
+        if '.xlsx' in filename:
+            df = self.prepare_input(pd.read_excel(io.BytesIO(upload)))
         else:
-            return 'Please input a .xlsx file. Current file is in a different format'
+            df = pd.concat(self.iter_upload(filename, io.BytesIO(upload)), ignore_index=True)
+
+        # Only the input UTM zones are needed, the workers query the PROJECT trees with the coordinates of each zone
+        needed_zones = list(df.z.unique())
+        input_trees = dict((str(x), None) for x in needed_zones)
+        return df, input_trees, needed_zones
 
+    def iter_upload(self, filename, stream, chunksize=None):
+        """
+        Parses a .csv, .parquet, .ndjson or .jsonl file in chunks, each one validated and converted to UTM like the
+        data frame of parse_upload, so large files can be scored without holding all of them in memory
+        :param filename: name of the file, its extension gives the format
+        :param stream: seekable binary file object
+        :param chunksize: rows per chunk, defaults to INPUT_CHUNK_ROWS
+        :return: generator of data frames
+        """
+        for chunk in read_input_chunks(filename, stream, chunksize or self.INPUT_CHUNK_ROWS):
+            yield self.prepare_input(chunk)
+
+    def prepare_input(self, df):
+        """
+        Validates the columns of an uploaded data frame, or of one of its chunks, and adds the count and UTM columns
+        :param df: Data frame of the uploaded file
+        :return: Data frame with lower case column names, count columns and x, y, z, zl columns
+        """
         # Check for missing required columns
-        required_columns = ['city', 'latitude', 'longitude', 'num_chargers', 'provider']
         df.rename(columns=lambda x: x.lower(), inplace=True)
         column_names = list(df.columns.values)
         missing = []
-        for req in required_columns:
+        for req in self.INPUT_DTYPES:
             if req not in column_names:
                 missing.append(req)
         if len(missing) is not 0:
-            logging.info('Missing following columns: ' + missing)
+            logging.info('Missing following columns: ' + str(missing))
             raise MissingColumnException(missing)
 
         # Setup count columns
@@ -140,195 +277,307 @@ class util:
         df = df.fillna(-1)
 
         # Convert input coordinates to  UTM
-        df = self.calc_utm(df)
-
-        # Make spatial trees for each of the input UTM zones
-        utm_zones = df.z.unique()
-        needed_zones = []
-        input_trees = {}
-        for each_utm_zone in utm_zones:
-            needed_zones.append(each_utm_zone)
-            utm_zone_coords = df[df.z == each_utm_zone]
-            utm_tree = cKDTree(utm_zone_coords[['x', 'y']])
+        with metrics.STAGE_SECONDS.time('utm'):
+            return self.calc_utm(df)
 
-            # Store the results in a dictionary mapping between UTM zones and tree objects
-            input_trees[str(each_utm_zone)] = utm_tree
-
-        # return the dictionary of spatial trees for the input coordinates
-        return df, input_trees, needed_zones
-
-    def multiprocess_query(self, df, input_trees, PROJECT_trees):
+    def multiprocess_query(self, df, input_trees, PROJECT_trees, pool=None, per_week=False, exact=True,
+                           result_cache=None, version=None):
         """
         Queries the input file against all relevant PROJECT tree data to generate number of points within certain radii
         :param df: Generated Data frame of input file from parser
-        :param input_trees: Dictionary mapping utm zone to tree
-        :param PROJECT_trees: Relevant tree data corresponding to only the needed UTM zones
+        :param input_trees: Dictionary keyed by the input utm zones, the values are not used
+        :param PROJECT_trees: Paths of the trees of the needed UTM zones, from load_needed_trees
+        :param pool: Long lived ZoneQueryPool, a temporary pool is started for this call if None
+        :param per_week: Also add the counts of each week as num_pts<radius>_<week> columns, needs weekly trees
+        :param exact: Query the trees, if False zones with a density grid are answered from the grid instead
+        :param result_cache: ResultCache of the counts of previously queried addresses, not used with per_week
+        :param version: Snapshot version PROJECT_trees were loaded from, needed with result_cache
         :return: Data frame with additional columns corresponding to points within different radii
         """
-
-        # Use max available processors - 1
-        pool = Pool(processes=cpu_count() - 1)
-        pool.daemon = True
-        results = {}
-        counter = 0
+        temporary_pool = pool is None
+        if temporary_pool:
+            pool = ZoneQueryPool()
+
+        zones = df.z.to_numpy()
+        coords = df[['x', 'y']].to_numpy(dtype=float)
+        counts = np.zeros((len(df), len(self.PROXIMITY_RADII)), dtype=np.int64)
+        week_counts = {}
+        results = []
+
+        # Only addresses missing from the result cache are sent to the workers
+        pending = np.ones(len(df), dtype=bool)
+        if result_cache is not None and not per_week:
+            cache_keys = result_cache.keys(zones, coords, exact)
+            pending = result_cache.get_many(version, cache_keys, counts)
 
         # Figure out which trees to query based on input trees
-        for k, v in input_trees.items():
-            input_tuple = (k, v)
-            for key, value in PROJECT_trees.items():
-                PROJECT_tuple = (key, value)
-
-                # If the input UTM zone is in the spatial tree filename
-                string = 'utm_' + str(input_tuple[0]) + '.tree'
-                if string in PROJECT_tuple[0]:
-                    # Start multiple processes for all trees matching that UTM zone
-                    results[counter] = pool.apply_async(query_trees, args=(df, input_tuple, PROJECT_tuple))
-                    counter += 1
-
-        # Wait for all processes to finish before proceeding
-        pool.close()
-        pool.join()
-
-        # Concatenate the results
-        df_all = input_trees
-        if results:
-            df_all = pd.concat(
-                {item: result.get() for item, result in results.items() if isinstance(result.get(), pd.DataFrame)},
-                ignore_index=True)
-            df_all = df_all.dropna(axis=1, how='all')
-
-        col_names = list(df_all.columns)
-
-        # Make list of columns to not group by
-        dont_group = ['num_pts200', 'num_pts400', 'num_pts800', 'num_pts1600', 'x', 'y', 'z', 'zl']
-
-        # Remove above columns from current columns
-        col_names = [x for x in col_names if x not in dont_group]
-
-        # Group by col_names, and sum the count columns
-        df = df_all.groupby(by=col_names)[['num_pts200', 'num_pts400', 'num_pts800', 'num_pts1600']].sum()
-        df = df.reset_index()
-
-        if not df.empty:
-            return df
-        else:
-            return results
-
-    def score_locations(self, df):
+        for zone in input_trees:
+            rows = np.flatnonzero((zones == int(zone)) & pending)
+            if len(rows) == 0:
+                continue
+            for tree_path in PROJECT_trees:
+
+                # If the input UTM zone is in the spatial tree filename, only ship that zone's coordinates
+                if 'utm_' + str(zone) + '.tree' in os.path.basename(tree_path):
+                    grid_path = tree_path[:-len('.tree')] + '.grid'
+                    if not exact and os.path.isdir(grid_path):
+                        counts[rows] += DensityGrid.load(grid_path).count_within_radii(coords[rows],
+                                                                                       self.PROXIMITY_RADII)
+                        continue
+                    results.append((tree_path, rows, pool.apply_async(tree_path, coords[rows])))
+
+        # Sum the counts of every week's tree into the rows of its zone
+        for tree_path, rows, result in results:
+            tree_counts = result.get()
+            counts[rows] += tree_counts
+
+            week = re.search(r'\d{4}-\d{2}-\d{2}', os.path.basename(tree_path))
+            if per_week and week:
+                week_counts.setdefault(week.group(0), np.zeros_like(counts))[rows] += tree_counts
+
+        if temporary_pool:
+            pool.close()
+
+        if result_cache is not None and not per_week:
+            result_cache.put_many(version, cache_keys, counts, pending)
+
+        for i, rad in enumerate(self.PROXIMITY_RADII):
+            df['num_pts%i' % rad] = counts[:, i]
+        for week in sorted(week_counts):
+            for i, rad in enumerate(self.PROXIMITY_RADII):
+                df['num_pts%i_%s' % (rad, week)] = week_counts[week][:, i]
+        return df.drop(columns=['x', 'y', 'z', 'zl'])
+
+    def score_locations(self, df, weights=None, maxima=None):
         """
         Generates a score for each location
         :param df: Original data frame
+        :param weights: Dictionary mapping score column to the weight of each count column, defaults to SCORE_WEIGHTS
+        :param maxima: Per city maxima from city_maxima, to score one chunk of a larger input, defaults to the maxima of df
         :return: Data frame with additional columns for score with chargers and without chargers
         """
         # Convert city name to title case
-        df['city'] = df['city'].str.replace("_", " ")
-        df['city'] = df['city'].str.title()
-
-        # Make list of cities
-        cities = df['city'].unique().tolist()
-        dfs = []
-        for each_city in range(len(cities)):
-            # Calculate score for that city
-            city_column = calc_score(df[df['city'] == cities[each_city]])
-            dfs.append(city_column)
-
-        # Merge results
-        if len(dfs) > 1:
-            df = pd.concat(dfs, ignore_index=True)
-        else:
-            df = dfs[0]
-        return df
+        df['city'] = normalize_cities(df['city'])
+
+        # Keep the rows of each city together, in order of first appearance
+        city_order = np.argsort(pd.factorize(df['city'])[0], kind='stable')
+        df = df.iloc[city_order].reset_index(drop=True)
 
-    def rank_locations(self, df):
+        # Calculate the scores of every city at once
+        return calc_score(df, weights, maxima)
+
+    def rank_locations(self, df, labels=None, score_range=None):
         """
         Generates a ranking for each location ranging from lowest, low, mid, high, highest
         :param df: Original data frame
+        :param labels: Ranking labels from lowest to highest, one per category, defaults to RANKING_LABELS
+        :param score_range: Per city score range from city_score_range, to rank one chunk of a larger input, defaults to the range of df
         :return: Data frame with additional column for ranking
         """
-        cities = df['city'].unique()
-        df['ranking'] = ''
-        num_categories = 5
-        for each_city in cities:
-
-            city_column = df[df['city'] == str(each_city)]
-            max_score = city_column.score_nochargers.max()
-            min_score = city_column.score_nochargers.min()
-            score_ranges = (max_score - min_score) / num_categories
-
-            for index, row in city_column.iterrows():
-                if min_score <= row['score_nochargers'] < min_score + score_ranges:
-                    df['ranking'].iloc[index] = 'Lowest'
-                elif min_score + score_ranges <= row['score_nochargers'] < min_score + score_ranges * 2:
-                    df['ranking'].iloc[index] = 'Low'
-                elif min_score + score_ranges * 2 <= row['score_nochargers'] <= min_score + score_ranges * 3:
-                    df['ranking'].iloc[index] = 'Mid'
-                elif min_score + score_ranges * 3 <= row['score_nochargers'] <= min_score + score_ranges * 4:
-                    df['ranking'].iloc[index] = 'High'
-                elif min_score + score_ranges * 4 <= row['score_nochargers'] <= max_score:
-                    df['ranking'].iloc[index] = 'Highest'
-                else:
-                    df['ranking'].iloc[index] = 'error'
+        if labels is None:
+            labels = self.RANKING_LABELS
+        num_categories = len(labels)
+        mid = num_categories // 2
+
+        score = df['score_nochargers'].to_numpy(dtype=float)
+        if score_range is None:
+            by_city = df.groupby('city')['score_nochargers']
+            min_score = by_city.transform('min').to_numpy(dtype=float)
+            max_score = by_city.transform('max').to_numpy(dtype=float)
+        else:
+            row_range = score_range.reindex(df['city'].to_numpy())
+            min_score = row_range['min'].to_numpy(dtype=float)
+            max_score = row_range['max'].to_numpy(dtype=float)
+        score_ranges = (max_score - min_score) / num_categories
+
+        # Inner bin edges of every row's city, shape (n, num_categories - 1)
+        edges = min_score[:, None] + score_ranges[:, None] * np.arange(1, num_categories)
+
+        # Categories below the middle one include their lower edge, the ones above include their upper edge
+        lower = (edges <= score[:, None]).sum(axis=1)
+        upper = (edges < score[:, None]).sum(axis=1)
+        category = np.where(lower <= mid, lower, np.maximum(upper, mid))
+
+        in_range = (min_score <= score) & (score <= max_score)
+        df['ranking'] = np.where(in_range, np.array(labels, dtype=object)[category], 'error')
         df = df.sort_values(by='score_nochargers', ascending=False)
         return df
 
-    def s3_query(self, s3_path):
+    def s3_client(self, max_pool_connections=10):
+        return boto3.client('s3', endpoint_url=self.S3_ENDPOINT, aws_access_key_id=self.S3_USER,
+                            aws_secret_access_key=self.decrypted_key,
+                            config=Config(max_pool_connections=max_pool_connections))
+
+    def s3_list_partitions(self, s3_conn):
+        """
+        Lists the weekly date partitions under S3_TREE_PREFIX without listing the objects inside them. If there are
+        none directly under the prefix, e.g. with a nested layout, the folders of all tree files are used instead
+        :param s3_conn: S3 client
+        :return: list of partition names, e.g. trees/2019-01-07
+        """
+        partitions = []
+        for prefix in list_s3_objects(s3_conn, self.S3_BUCKET, self.S3_TREE_PREFIX, delimiter='/'):
+            if re.search(r'\d{4}-\d{2}-\d{2}$', prefix.rstrip('/')):
+                partitions.append(prefix.rstrip('/'))
+        if partitions:
+            return partitions
+
+        logging.warning('No date partitions under S3 prefix "' + self.S3_TREE_PREFIX + '", listing every tree file')
+        for key in self.s3_query('.tree', s3_conn=s3_conn):
+            if key[:1] != '/':
+                partitions.append(os.path.dirname(key))
+        return list(set(partitions))
+
+    def s3_query(self, s3_path, partitions=None, s3_conn=None):
         """
-        Generates a list of all files containing the substring specified
+        Generates a list of all files containing the substring specified. If partitions are given only those are
+        listed, and the listings of all but the newest partition are kept in a local manifest so repeated refreshes
+        only list partitions they have not seen before
         :param s3_path: substring to query for
+        :param partitions: Optional list of date partitions to restrict the listing to
+        :param s3_conn: Optional S3 client
         :return: a list of all tree files
         """
-        s3 = boto3.resource('s3', endpoint_url=self.S3_ENDPOINT, aws_access_key_id=self.S3_USER, aws_secret_access_key=self.decrypted_key)
+        if s3_conn is None:
+            s3_conn = self.s3_client()
+        if partitions is None:
+            return [key for key in list_s3_objects(s3_conn, self.S3_BUCKET) if s3_path in key]
 
-        bucket = s3.Bucket(self.S3_BUCKET)
-        files = []
+        try:
+            with open(self.S3_MANIFEST_FILE) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+        listings = manifest.setdefault(self.S3_BUCKET, {})
 
-        for object in bucket.objects.all():
-            if s3_path in object.key:
-                files.append(object.key)
+        files = []
+        newest = max(partitions) if partitions else None
+        for partition in partitions:
+            # The newest partition may still be filling up, it is always listed again
+            if partition not in listings or partition == newest:
+                listings[partition] = list(list_s3_objects(s3_conn, self.S3_BUCKET, partition + '/'))
+            files += [key for key in listings[partition] if s3_path in key]
+
+        tmp_file = self.S3_MANIFEST_FILE + '.tmp'
+        with open(tmp_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_file, self.S3_MANIFEST_FILE)
         return files
 
-    def s3_download(self, file_list, file_type, folder):
+    def s3_download(self, file_list, file_type, folder, s3_conn=None, max_workers=None):
         """
-        Downloads all files based on the file list and saves them into a specified folder
+        Downloads all files based on the file list and saves them into a specified folder. Files are fetched
+        concurrently by a bounded thread pool, streamed to temporary files and moved into place atomically
         :param file_list: list of files to be downloaded
         :param file_type: substring indicating type of file to be downloaded
         :param folder: folder to download to
+        :param s3_conn: Optional S3 client, e.g. a LocalS3Client, a boto3 client is created if None
+        :param max_workers: Maximum number of concurrent downloads, defaults to DOWNLOAD_CONCURRENCY
         :return: Dictionary mapping of file to file path
         """
-        new_dictionary = {}
-        s3_conn = boto3.client('s3', endpoint_url=self.S3_ENDPOINT, aws_access_key_id=self.S3_USER,
-                               aws_secret_access_key=self.decrypted_key)
+        max_workers = max_workers or self.DOWNLOAD_CONCURRENCY
+        if s3_conn is None:
+            s3_conn = self.s3_client(max_workers)
         try:
             os.mkdir(folder)
         except OSError:
             pass
-        for each_file in file_list:
-
-            obj = s3_conn.get_object(Bucket=self.S3_BUCKET, Key=each_file)
-            body = obj['Body']
-            if file_type == '.tree':
-                var = pickle.loads(body.read())
-
-                with open(os.path.join(folder, os.path.basename(each_file)), 'wb') as new_file:
-                    pickle.dump(var, new_file, protocol=pickle.HIGHEST_PROTOCOL)
-                    new_file.close()
-                    new_dictionary[str(each_file)] = os.path.join(folder, os.path.basename(each_file))
-        if file_type == '.tree':
-            return new_dictionary
-
-    def load_needed_trees(self, needed_zones, folder=settings['directories']['current_tree_folder']):
-        tree_dict = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {each_file: executor.submit(self.download_file, s3_conn, each_file, file_type, folder)
+                       for each_file in file_list}
+            return {str(each_file): future.result() for each_file, future in futures.items()}
+
+    def download_file(self, s3_conn, s3_path, file_type, folder):
+        """
+        Copies one object from the shared S3 object cache, which downloads it if it changed, to a temporary file in
+        the folder and moves it into place, retrying with exponential backoff. Trees bypass the cache and are
+        converted to the memory-mappable index format on the way
+        :param s3_conn: S3 client
+        :param s3_path: key of the object to download
+        :param file_type: substring indicating type of file to be downloaded
+        :param folder: folder to download to
+        :return: path of the downloaded file
+        """
+        path = os.path.join(folder, os.path.basename(s3_path))
+        for attempt in range(self.DOWNLOAD_RETRIES + 1):
+            tmp_file = tempfile.NamedTemporaryFile(dir=folder, prefix='.', suffix='.download', delete=False)
+            try:
+                cached, downloaded = s3_cache.fetch(s3_conn, self.S3_BUCKET, s3_path)
+                metrics.S3_DOWNLOAD_BYTES.inc(downloaded)
+                with tmp_file, cached:
+                    if file_type == '.tree':
+                        # Trees are stored pickled in S3, convert them once to the memory-mappable index format
+                        save_tree(pickle.load(cached), path)
+                    else:
+                        shutil.copyfileobj(cached, tmp_file, self.DOWNLOAD_CHUNK_SIZE)
+
+                if file_type != '.tree':
+                    os.replace(tmp_file.name, path)
+                return path
+            except Exception as e:
+                if attempt == self.DOWNLOAD_RETRIES:
+                    raise
+                logging.warning('Download of ' + s3_path + ' failed, retrying: ' + str(e))
+                time.sleep(self.DOWNLOAD_BACKOFF * 2 ** attempt)
+            finally:
+                if os.path.exists(tmp_file.name):
+                    os.remove(tmp_file.name)
+
+    def load_needed_trees(self, needed_zones, folder=None, listings=None, per_week=False):
+        """
+        Finds the trees of the needed UTM zones. The merged index of a zone is used when it exists, otherwise every
+        weekly tree of the zone. The trees themselves are loaded by the query workers, see ZoneQueryPool
+        :param needed_zones: UTM zones needed to calculate scores
+        :param folder: The folder containing the tree files, defaults to the current snapshot
+        :param listings: Optional FolderListingCache, used to skip the folder scans while the folders are unchanged
+        :param per_week: Use the weekly trees even if a merged index exists, needed for per week breakdowns
+        :return: list of tree paths
+        """
+        if folder is None:
+            folder = self.current_snapshot() or settings['directories']['current_tree_folder']
+        list_folder = os.listdir if listings is None else listings.list_folder
+
+        merged_folder = os.path.join(folder, self.MERGED_TREE_FOLDER)
+        merged_files = []
+        if not per_week and os.path.isdir(merged_folder):
+            merged_files = list_folder(merged_folder)
+
+        tree_paths = []
         for zone in needed_zones:
-            for filename in os.listdir(folder):
+            merged_file = 'utm_{}.tree'.format(zone)
+            if merged_file in merged_files:
+                tree_paths.append(os.path.join(merged_folder, merged_file))
+                continue
+            for filename in list_folder(folder):
                 if filename.endswith('{}.tree'.format(zone)):
-                    with open(os.path.join(folder, filename), 'rb') as f:
-                        var = pickle.load(f)
-                        tree_dict[os.path.basename(filename)] = var
-        return tree_dict
+                    tree_paths.append(os.path.join(folder, filename))
+        return tree_paths
 
     def calc_utm(self, df):
+        """
+        Converts the latitude/longitude columns to UTM. Rows are grouped by zone number and zone letter so each group
+        is projected with a single vectorized utm.from_latlon call instead of one call per row
+        :param df: Data frame containing latitude and longitude columns
+        :return: Data frame with additional x, y, z, zl columns
+        """
         logging.info('Step 2 Convert the lat/lon to UTM')
-        df[['x', 'y', 'z', 'zl']] = df.apply(lambda x: pd.Series(utm.from_latlon(x.latitude, x.longitude)), axis=1)
+        latitude = df['latitude'].to_numpy(dtype=float)
+        longitude = df['longitude'].to_numpy(dtype=float)
+        x = np.empty(len(df))
+        y = np.empty(len(df))
+        z = latlon_to_zone_numbers(latitude, longitude)
+        zl = latitude_to_zone_letters(latitude)
+
+        groups = pd.DataFrame({'z': z, 'zl': zl}).groupby(['z', 'zl'], dropna=False).indices
+        for (zone_number, zone_letter), rows in groups.items():
+            x[rows], y[rows], _, _ = utm.from_latlon(latitude[rows], longitude[rows],
+                                                     force_zone_number=zone_number, force_zone_letter=zone_letter)
+
+        df['x'] = x
+        df['y'] = y
+        df['z'] = z
+        df['zl'] = zl
         return df
 
     def replace_null(self, df):
@@ -339,60 +588,645 @@ class util:
         return df
 
 
-class MissingColumnException(Exception):
-    pass
+class LocalS3Client:
+    """
+    Stand-in for the boto3 S3 client backed by a local directory, one sub folder per bucket. Used to run the
+    download and listing code in tests and benchmarks without S3
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        path = os.path.join(self.root, Bucket, Key)
+        if not os.path.isfile(path):
+            raise KeyError(Key)
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': open(path, 'rb'), 'ContentLength': stat.st_size, 'ETag': etag}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter='', **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for dir_path, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                keys.append(os.path.relpath(os.path.join(dir_path, filename), bucket_root).replace(os.sep, '/'))
+
+        contents = []
+        common_prefixes = []
+        for key in sorted(keys):
+            if not key.startswith(Prefix) or key <= StartAfter:
+                continue
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:key.index(Delimiter, len(Prefix)) + 1]
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+            else:
+                contents.append({'Key': key, 'Size': os.path.getsize(os.path.join(bucket_root, key))})
+        return {'Contents': contents, 'CommonPrefixes': [{'Prefix': x} for x in common_prefixes],
+                'IsTruncated': False}
+
+    def put_object(self, Body, Bucket, Key):
+        path = os.path.join(self.root, Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body.encode('utf-8') if isinstance(Body, str) else Body)
+
+
+class DensityGrid:
+    """
+    Summed-area table of the points of a merged tree on a regular grid. Counts within a radius are answered by adding
+    up the few rectangles covering the cells whose centers lie within the radius of the address's cell center, so the
+    cost per address does not depend on the number of points. The count is exact for points closer than
+    radius - cell_size * sqrt(2) and never includes points further than radius + cell_size * sqrt(2)
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, sat, x0, y0, cell_size):
+        self.sat = sat
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_size = cell_size
+
+    @classmethod
+    def build(cls, points, cell_size, padding=0):
+        """
+        :param points: (n, 2) array of UTM coordinates
+        :param cell_size: Cell size in meters
+        :param padding: Meters added around the bounding box of the points
+        :return: DensityGrid
+        """
+        x0, y0 = points.min(axis=0) - padding
+        nx, ny = (np.floor((points.max(axis=0) + padding - [x0, y0]) / cell_size) + 1).astype(int)
+        ix = ((points[:, 0] - x0) // cell_size).astype(np.int64)
+        iy = ((points[:, 1] - y0) // cell_size).astype(np.int64)
+
+        dtype = np.int32 if len(points) < 2 ** 31 else np.int64
+        sat = np.zeros((ny + 1, nx + 1), dtype=dtype)
+        sat[1:, 1:] = np.bincount(iy * nx + ix, minlength=nx * ny).reshape(ny, nx).cumsum(axis=0).cumsum(axis=1)
+        return cls(sat, float(x0), float(y0), float(cell_size))
+
+    def save(self, path, extra_meta=None):
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'sat.npy'), self.sat)
+        meta = {'format_version': self.FORMAT_VERSION, 'x0': self.x0, 'y0': self.y0, 'cell_size': self.cell_size}
+        meta.update(extra_meta or {})
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        meta = load_tree_meta(path)
+        if meta['format_version'] > cls.FORMAT_VERSION:
+            raise UnsupportedTreeFormatException(path)
+        return cls(np.load(os.path.join(path, 'sat.npy'), mmap_mode='r'), meta['x0'], meta['y0'], meta['cell_size'])
+
+    def count_within_radii(self, coords, radii):
+        """
+        Approximate version of count_within_radii
+        :param coords: (n, 2) array of coordinates
+        :param radii: list of radii
+        :return: (n, len(radii)) array of point counts
+        """
+        ny, nx = self.sat.shape[0] - 1, self.sat.shape[1] - 1
+        ix = np.floor((coords[:, 0] - self.x0) / self.cell_size).astype(np.int64)
+        iy = np.floor((coords[:, 1] - self.y0) / self.cell_size).astype(np.int64)
+
+        counts = np.zeros((len(coords), len(radii)), dtype=np.int64)
+        for i, radius in enumerate(radii):
+            for dy0, dy1, half_width in disk_rectangles(radius / self.cell_size):
+                row0, row1 = np.clip(iy + dy0, 0, ny), np.clip(iy + dy1 + 1, 0, ny)
+                col0, col1 = np.clip(ix - half_width, 0, nx), np.clip(ix + half_width + 1, 0, nx)
+                counts[:, i] += (self.sat[row1, col1] - self.sat[row0, col1] - self.sat[row1, col0] +
+                                 self.sat[row0, col0])
+        return counts
+
+
+class ZoneQueryPool:
+    """
+    Long lived process pool for multiprocess_query. It is created once at service start, each worker keeps the memory
+    mapped trees it queries in a TreeCache of max_bytes between requests. The hit/miss counts of the workers' caches
+    are shared with the pool
+    """
+    def __init__(self, folder=None, processes=None, max_bytes=None):
+        self.folder = folder
+        self.tree_stats = Array('q', len(TreeCache.SHARED_STATS))
+        self.pool = Pool(processes=processes or max(cpu_count() - 1, 1), initializer=init_query_worker,
+                         initargs=(folder, max_bytes, self.tree_stats))
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def apply_async(self, tree_path, coords):
+        """
+        Counts the points of a tree around the given coordinates in a worker
+        :param tree_path: Path of the tree to query
+        :param coords: (n, 2) array of UTM coordinates
+        :return: AsyncResult of a (n, len(PROXIMITY_RADII)) count array
+        """
+        with self.lock:
+            self.pending += 1
+        return self.pool.apply_async(query_trees, args=(tree_path, coords), callback=self.task_done,
+                                     error_callback=self.task_done)
 
+    def task_done(self, result):
+        with self.lock:
+            self.pending -= 1
 
-class InvalidDateFormatException(Exception):
-    pass
+    def queue_depth(self):
+        """
+        :return: Number of queries submitted and not finished yet
+        """
+        return self.pending
 
+    def tree_cache_stats(self):
+        """
+        :return: Dictionary of the hits, misses and evictions of the tree caches of all workers
+        """
+        with self.tree_stats.get_lock():
+            return dict(zip(TreeCache.SHARED_STATS, self.tree_stats[:]))
 
-def calc_score(df):
-    df.num_pts1600 = df.num_pts1600 - df.num_pts800
-    df.num_pts800 = df.num_pts800 - df.num_pts400
-    df.num_pts400 = df.num_pts400 - df.num_pts200
-    m200 = df.num_pts200.max()
-    m400 = df.num_pts400.max()
-    m800 = df.num_pts800.max()
-    m1600 = df.num_pts1600.max()
-    mchargers = df.num_chargers.max()
-    df['score_nochargers'] = df.apply(score_no_charge, args=(m200, m400, m800, m1600), axis=1)
-    df['score_chargers'] = df.apply(score_charge, args=(m200, m400, m800, m1600, mchargers), axis=1)
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
-    return df.replace(pd.np.nan, 0.0, regex=True)
 
+class FolderListingCache:
+    """
+    Listings of tree folders, reused while the folder modification time is unchanged
+    """
+    def __init__(self):
+        self.folder_listings = {}
 
-def query_trees(df, input_tuple, PROJECT_tuple):
-    # Get the row numbers in the input file
-    rows = df[df.z == int(input_tuple[0])]
+    def list_folder(self, folder):
+        """
+        :param folder: The folder containing the tree files
+        :return: list of file names
+        """
+        version = os.stat(folder).st_mtime_ns
+        listing = self.folder_listings.get(folder)
+        if listing is None or listing[0] != version:
+            listing = (version, os.listdir(folder))
+            self.folder_listings[folder] = listing
+        return listing[1]
+
+
+class TreeCache:
+    """
+    Size bounded, thread safe LRU cache of loaded trees. Entries are keyed by tree path and the snapshot version of
+    the file, so a tree replaced on disk is reloaded, and trees whose file was deleted are dropped on the next miss.
+    Trees are evicted once the cache holds more than max_bytes. With shared_stats, an Array of one counter per
+    SHARED_STATS name, the counts are also added up across processes
+    """
+    SHARED_STATS = ('hits', 'misses', 'evictions')
+
+    def __init__(self, max_bytes=None, shared_stats=None):
+        if max_bytes is None:
+            max_bytes = settings['util_config'].get('tree_cache_mb', 2048) * 2 ** 20
+        self.max_bytes = max_bytes
+        self.shared_stats = shared_stats
+        self.trees = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def count(self, stat, amount=1):
+        setattr(self, stat, getattr(self, stat) + amount)
+        if self.shared_stats is not None and amount:
+            with self.shared_stats.get_lock():
+                self.shared_stats[self.SHARED_STATS.index(stat)] += amount
+
+    def get(self, path):
+        """
+        Returns the tree stored at path, loading it on a miss
+        :param path: Path of the tree
+        :return: cKDTree
+        """
+        key = (path, tree_version(path))
+        with self.lock:
+            if key in self.trees:
+                self.trees.move_to_end(key)
+                self.count('hits')
+                return self.trees[key][0]
+            self.count('misses')
+
+            # Forget trees that were deleted by an update so their pages can be released
+            for stale_key in [x for x in self.trees if not os.path.exists(x[0])]:
+                self.current_bytes -= self.trees.pop(stale_key)[1]
+
+        tree = load_tree(path)
+        size = tree_nbytes(tree)
+        with self.lock:
+            if key not in self.trees:
+                self.trees[key] = (tree, size)
+                self.current_bytes += size
+            # Evict least recently used trees, always keeping the one just loaded
+            evictions = 0
+            while self.current_bytes > self.max_bytes and len(self.trees) > 1:
+                _, (_, evicted_size) = self.trees.popitem(last=False)
+                self.current_bytes -= evicted_size
+                evictions += 1
+            self.count('evictions', evictions)
+        return tree
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss statistics and current size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': len(self.trees),
+                    'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
+class ResultCache:
+    """
+    Size bounded, thread safe LRU cache of the radius counts of scored addresses, keyed by UTM zone and coordinates
+    rounded to resolution meters. Counts are only valid for the tree snapshot they were queried from, entries of
+    older snapshots are dropped as soon as a lookup names a newer one, so publishing trees invalidates the cache
+    """
+    def __init__(self, max_entries=None, resolution=None):
+        if max_entries is None:
+            max_entries = settings['util_config'].get('result_cache_entries', 1000000)
+        if resolution is None:
+            resolution = settings['util_config'].get('result_cache_resolution_m', 1.0)
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.counts = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def keys(self, zones, coords, exact=True):
+        """
+        :param zones: array of UTM zone numbers
+        :param coords: (n, 2) array of UTM coordinates
+        :param exact: Whether the counts come from the trees or from density grids
+        :return: list of cache keys, one per row
+        """
+        rounded = np.round(coords / self.resolution).astype(np.int64)
+        return list(zip(zones.tolist(), rounded[:, 0].tolist(), rounded[:, 1].tolist(), [exact] * len(zones)))
 
-    # For each radius
-    for rad in util.PROXIMITY_RADII:
+    def get_many(self, version, keys, counts):
+        """
+        Fills the rows of counts found in the cache
+        :param version: Snapshot version the counts are for
+        :param keys: Cache keys from keys()
+        :param counts: (n, len(PROXIMITY_RADII)) array, cached rows are written in place
+        :return: boolean array of the rows that were not found
+        """
+        pending = np.ones(len(keys), dtype=bool)
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.evictions += len(self.counts)
+                self.counts.clear()
+                self.version = version
+            if version != self.version:
+                self.misses += len(keys)
+                return pending
+
+            for row, key in enumerate(keys):
+                cached = self.counts.get(key)
+                if cached is not None:
+                    self.counts.move_to_end(key)
+                    counts[row] = cached
+                    pending[row] = False
+            found = len(keys) - int(pending.sum())
+            self.hits += found
+            self.misses += len(keys) - found
+        return pending
+
+    def put_many(self, version, keys, counts, rows):
+        """
+        Stores the counts of the queried rows
+        :param version: Snapshot version the counts were queried from
+        :param keys: Cache keys from keys()
+        :param counts: (n, len(PROXIMITY_RADII)) array of counts
+        :param rows: boolean array of the rows to store
+        """
+        with self.lock:
+            # Counts of a snapshot replaced while they were queried are not kept
+            if version != self.version:
+                return
+            for row in np.flatnonzero(rows):
+                self.counts[keys[row]] = counts[row].copy()
+                self.counts.move_to_end(keys[row])
+            while len(self.counts) > self.max_entries:
+                self.counts.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss statistics and current size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': len(self.counts),
+                    'max_entries': self.max_entries, 'version': self.version}
 
-        # Have the input tree query the PROJECT tree
-        results = input_tuple[1].query_ball_tree(PROJECT_tuple[1], r=rad)
 
-        # Update the proper rows in the input file with the counts
-        df['num_pts%i' % rad].iloc[rows.index] = pd.Series([len(i) for i in results], index=rows.index)
-    return df
+def tree_version(path):
+    """
+    Snapshot version of a tree file, changes whenever the file or index directory is replaced
+    :param path: Path of the tree
+    :return: tuple of inode and modification time
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def tree_nbytes(tree):
+    """
+    :param tree: cKDTree
+    :return: Approximate memory used by the tree's points and indices
+    """
+    return tree.data.nbytes + tree.indices.nbytes
+
+
+# TreeCache of a ZoneQueryPool worker, created by init_query_worker
+worker_cache = None
+
+
+class MissingColumnException(Exception):
+    pass
 
 
-def score_no_charge(row, m2, m4, m8, m16):
-    if row.num_pts200 + row.num_pts400 + row.num_pts800 + row.num_pts1600 != 0:
-        return round(100. * (
-                0.4 * row.num_pts200 / m2 + 0.3 * row.num_pts400 / m4 + 0.2 * row.num_pts800 / m8 + 0.1 * row.num_pts1600 / m16),
-                     0)
+class InvalidDateFormatException(Exception):
+    pass
+
+
+class UnsupportedTreeFormatException(Exception):
+    pass
+
+
+class UnsupportedFileFormatException(Exception):
+    pass
+
+
+def calc_score(df, weights=None, maxima=None):
+    """
+    Vectorized scoring engine. Computes the ring differences, the per city maxima and every weighted score over the
+    whole frame. A score is 0 when a location has no points in any ring, or when the maximum of one of its non ring
+    columns is 0. Terms dividing 0 by a city maximum of 0 still make the score 0
+    :param df: Data frame with city, count and num_chargers columns
+    :param weights: Dictionary mapping score column to the weight of each count column, defaults to SCORE_WEIGHTS
+    :param maxima: Data frame of per city maxima indexed by city, as returned by city_maxima, defaults to the maxima of df
+    :return: Data frame with additional score columns
+    """
+    if weights is None:
+        weights = util.SCORE_WEIGHTS
+    ring_columns = ['num_pts%i' % rad for rad in util.PROXIMITY_RADII]
+    ring_differences(df)
+
+    weighted_columns = sorted(set(column for score_weights in weights.values() for column in score_weights))
+    if maxima is None:
+        maxima = df.groupby('city')[weighted_columns].transform('max')
     else:
-        return 0
+        maxima = maxima.reindex(df['city'].to_numpy())
+    has_points = df[ring_columns].sum(axis=1).to_numpy() != 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for score_column, score_weights in weights.items():
+            total = 0.
+            valid = has_points.copy()
+            for column, weight in score_weights.items():
+                total = total + weight * df[column].to_numpy(dtype=float) / maxima[column].to_numpy(dtype=float)
+                if column not in ring_columns:
+                    valid &= maxima[column].to_numpy() != 0
+            df[score_column] = np.where(valid, np.round(100. * total, 0), 0.)
+
+    return df.replace(np.nan, 0.0)
+
+
+def ring_differences(df):
+    """
+    Turns the cumulative counts of df into counts per ring, in place
+    :param df: Data frame with a count column per radius
+    :return: df
+    """
+    ring_columns = ['num_pts%i' % rad for rad in util.PROXIMITY_RADII]
+
+    # Starting from the outer ring, so every inner count is still cumulative when it is subtracted
+    for outer, inner in reversed(list(zip(ring_columns[1:], ring_columns[:-1]))):
+        df[outer] = df[outer] - df[inner]
+    return df
 
 
-def score_charge(row, m2, m4, m8, m16, mc):
-    if row.num_pts200 + row.num_pts400 + row.num_pts800 + row.num_pts1600 != 0 and mc != 0:
-        return round((100. * (
-                0.25 * row.num_pts200 / m2 + 0.2 * row.num_pts400 / m4 + 0.15 * row.num_pts800 / m8 + 0.1 * row.num_pts1600 / m16 + 0.3 * row.num_chargers / mc)),
-                     0)
+def normalize_cities(cities):
+    """
+    Converts city names to the title case names used to group the scores
+    :param cities: Series of city names
+    :return: Series of normalized city names
+    """
+    return cities.str.replace("_", " ").str.title()
+
+
+def city_maxima(df, weights=None):
+    """
+    Per city maxima of the columns calc_score divides by, for scoring a large input one chunk at a time. The maxima of
+    several chunks combine with pd.concat(maxima).groupby(level=0).max()
+    :param df: Data frame with city, cumulative count and num_chargers columns, it is not modified
+    :param weights: Dictionary mapping score column to the weight of each count column, defaults to SCORE_WEIGHTS
+    :return: Data frame of maxima indexed by normalized city name
+    """
+    if weights is None:
+        weights = util.SCORE_WEIGHTS
+    weighted_columns = sorted(set(column for score_weights in weights.values() for column in score_weights))
+    ring_columns = ['num_pts%i' % rad for rad in util.PROXIMITY_RADII]
+
+    columns = df[sorted(set(weighted_columns) | set(ring_columns))].copy()
+    columns['city'] = normalize_cities(df['city'])
+    return ring_differences(columns).groupby('city')[weighted_columns].max()
+
+
+def city_score_range(df):
+    """
+    Per city minimum and maximum of score_nochargers, for ranking a large input one chunk at a time. The ranges of
+    several chunks combine with pd.concat(ranges).groupby(level=0).agg({'min': 'min', 'max': 'max'})
+    :param df: Scored data frame
+    :return: Data frame with min and max columns indexed by city
+    """
+    return df.groupby('city')['score_nochargers'].agg(['min', 'max'])
+
+
+def read_input_chunks(filename, stream, chunksize):
+    """
+    Reads a .csv, .parquet, .ndjson or .jsonl file in chunks, the required columns are parsed with util.INPUT_DTYPES
+    whatever the case of their names
+    :param filename: name of the file, its extension gives the format
+    :param stream: seekable binary file object
+    :param chunksize: rows per chunk
+    :return: generator of data frames with the original column names
+    """
+    extension = os.path.splitext(filename.lower())[1]
+    if extension not in util.CHUNKED_FORMATS:
+        raise UnsupportedFileFormatException('Please input a .xlsx, ' + ', '.join(util.CHUNKED_FORMATS) +
+                                             ' file. Current file is in a different format')
+
+    if extension == '.csv':
+        # Read the header first so the parser gets the dtypes under the names used in the file
+        header = pd.read_csv(stream, nrows=0).columns
+        stream.seek(0)
+        dtypes = dict((x, util.INPUT_DTYPES[x.lower()]) for x in header if x.lower() in util.INPUT_DTYPES)
+        chunks = pd.read_csv(stream, dtype=dtypes, chunksize=chunksize)
+    elif extension == '.parquet':
+        if pq is None:
+            raise UnsupportedFileFormatException('pyarrow is not installed, Parquet files are unavailable')
+        chunks = (x.to_pandas() for x in pq.ParquetFile(stream).iter_batches(batch_size=chunksize))
     else:
-        return 0
+        chunks = pd.read_json(stream, lines=True, dtype=False, chunksize=chunksize)
+
+    for chunk in chunks:
+        if extension != '.csv':
+            dtypes = dict((x, util.INPUT_DTYPES[x.lower()]) for x in chunk.columns if x.lower() in util.INPUT_DTYPES)
+            chunk = chunk.astype(dtypes)
+        yield chunk
+
+
+def query_trees(tree_path, coords):
+    """
+    Runs inside a ZoneQueryPool worker and counts the PROJECT points around each coordinate
+    :param tree_path: Path of the PROJECT tree to query, already loaded by the worker in most cases
+    :param coords: (n, 2) array of UTM coordinates of one zone
+    :return: (n, len(PROXIMITY_RADII)) array of point counts
+    """
+    global worker_cache
+    if worker_cache is None:
+        worker_cache = TreeCache()
+    return count_within_radii(worker_cache.get(tree_path), coords, util.PROXIMITY_RADII)
+
+
+def count_within_radii(tree, coords, radii):
+    """
+    Counts the tree points within every radius of each coordinate in a single counting traversal. Neighbor index
+    lists are never materialized, each (coordinate, radius) pair only produces its count
+    :param tree: cKDTree to query
+    :param coords: (n, 2) array of coordinates
+    :param radii: list of radii
+    :return: (n, len(radii)) array of point counts
+    """
+    radii = np.asarray(radii, dtype=float)
+    if len(coords) == 0:
+        return np.zeros((0, len(radii)), dtype=np.int64)
+    counts = tree.query_ball_point(np.repeat(coords, len(radii), axis=0), r=np.tile(radii, len(coords)),
+                                   return_length=True)
+    return counts.astype(np.int64).reshape(len(coords), len(radii))
+
+
+def init_query_worker(folder, max_bytes=None, shared_stats=None):
+    """
+    Pool initializer, creates the worker's tree cache and preloads the trees of the folder, as many as fit, so
+    requests only have to ship coordinates
+    :param folder: Folder of the trees the worker serves
+    :param max_bytes: Size of the worker's tree cache, defaults to the tree_cache_mb setting
+    :param shared_stats: Array of hit/miss counters shared with the ZoneQueryPool
+    """
+    global worker_cache
+    worker_cache = TreeCache(max_bytes, shared_stats)
+    if folder is None or not os.path.isdir(folder):
+        return
+    for each_folder in [os.path.join(folder, util.MERGED_TREE_FOLDER), folder]:
+        if os.path.isdir(each_folder):
+            for filename in os.listdir(each_folder):
+                if filename.endswith('.tree') and worker_cache.current_bytes < worker_cache.max_bytes:
+                    worker_cache.get(os.path.join(each_folder, filename))
+
+
+def latlon_to_zone_numbers(latitude, longitude):
+    """
+    Vectorized version of utm.latlon_to_zone_number, including the Norway and Svalbard exceptions
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :return: array of UTM zone numbers
+    """
+    longitude = (longitude % 360 + 540) % 360 - 180
+    zone_numbers = ((longitude + 180) / 6).astype(int) + 1
+
+    norway = (56 <= latitude) & (latitude < 64) & (3 <= longitude) & (longitude < 12)
+    zone_numbers[norway] = 32
+
+    svalbard = (72 <= latitude) & (latitude <= 84) & (longitude >= 0)
+    for lower, upper, zone_number in [(0, 9, 31), (9, 21, 33), (21, 33, 35), (33, 42, 37)]:
+        zone_numbers[svalbard & (lower <= longitude) & (longitude < upper)] = zone_number
+    return zone_numbers
+
+
+def latitude_to_zone_letters(latitude):
+    """
+    Vectorized version of utm.latitude_to_zone_letter
+    :param latitude: array of latitudes
+    :return: array of UTM zone letters, None where the latitude is outside the UTM range
+    """
+    in_range = (-80 <= latitude) & (latitude <= 84)
+    letters = np.array(list(utm.conversion.ZONE_LETTERS), dtype=object)
+    zone_letters = np.full(len(latitude), None, dtype=object)
+    zone_letters[in_range] = letters[(latitude[in_range] + 80).astype(int) >> 3]
+    return zone_letters
+
+
+def list_s3_objects(s3_conn, bucket, prefix='', delimiter=None):
+    """
+    Lists a bucket page by page
+    :param s3_conn: S3 client
+    :param bucket: bucket to list
+    :param prefix: only list keys starting with the prefix
+    :param delimiter: if given, yield the common prefixes up to the delimiter instead of the keys
+    :return: generator of keys or common prefixes
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    while True:
+        response = s3_conn.list_objects_v2(**kwargs)
+        if delimiter:
+            for common_prefix in response.get('CommonPrefixes', []):
+                yield common_prefix['Prefix']
+        else:
+            for each_object in response.get('Contents', []):
+                yield each_object['Key']
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def parse_end_day(end_day):
+    """
+    :param end_day: date, yyyy-mm-dd string or None for today
+    :return: date
+    """
+    try:
+        if isinstance(end_day, str):
+            end_day = dt.datetime.strptime(end_day, '%Y-%m-%d').date()
+        elif end_day is None:
+            end_day = dt.date.today()
+    except ValueError:
+        raise InvalidDateFormatException
+    return end_day
+
+
+def link_trees(source, target):
+    """
+    Hard links the weekly trees and merged indexes of a folder into another one
+    :param source: folder to link from
+    :param target: folder to link into
+    """
+    for filename in os.listdir(source):
+        if filename.endswith('.tree') or filename == util.MERGED_TREE_FOLDER:
+            if os.path.isdir(os.path.join(source, filename)):
+                shutil.copytree(os.path.join(source, filename), os.path.join(target, filename), copy_function=os.link)
+            else:
+                os.link(os.path.join(source, filename), os.path.join(target, filename))
 
 
 def evaluate_dates(dir_names, start_week, end_day):
@@ -448,4 +1282,170 @@ def get_delete_file_list(obsolete_weeks, tree_folder):
 def delete_files(files_to_delete, folder):
     for delete_file in files_to_delete:
         logging.info('Removing: ' + delete_file)
-        os.remove(os.path.join(folder, delete_file))
+        if os.path.isdir(os.path.join(folder, delete_file)):
+            shutil.rmtree(os.path.join(folder, delete_file))
+        else:
+            os.remove(os.path.join(folder, delete_file))
+
+
+def save_tree(tree, path, include_structure=True, extra_meta=None):
+    """
+    Saves a cKDTree in the versioned on-disk index format. The index is a directory holding meta.json, the raw points
+    as points.npy and optionally the serialized tree structure, so it can be opened again without unpickling
+    :param tree: cKDTree to save
+    :param path: index directory to write, replaced atomically if it already exists
+    :param include_structure: Also save the tree structure so loading does not have to rebuild the tree
+    :param extra_meta: Optional dictionary of additional entries for meta.json
+    :return: path of the saved index
+    """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, 'points.npy'), np.ascontiguousarray(tree.data, dtype=np.float64))
+    meta = {'format_version': util.TREE_FORMAT_VERSION, 'n': int(tree.n), 'm': int(tree.m),
+            'leafsize': int(tree.leafsize), 'structure': None}
+    meta.update(extra_meta or {})
+
+    # The structure is the internal cKDTree pickle state, it is only reused with the same scipy version
+    state = tree.__getstate__() if include_structure else None
+    if state is not None and len(state) == 10 and state[8] is None:
+        np.save(os.path.join(tmp_path, 'tree_buffer.npy'), state[0])
+        np.save(os.path.join(tmp_path, 'indices.npy'), state[7])
+        meta['structure'] = {'scipy_version': scipy.__version__, 'maxes': state[5].tolist(),
+                             'mins': state[6].tolist()}
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return path
+
+
+def load_tree_meta(path):
+    """
+    :param path: index directory written by save_tree
+    :return: Dictionary of the index meta data
+    """
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        return json.load(meta_file)
+
+
+def build_merged_trees(folder):
+    """
+    Builds one merged index per UTM zone containing the points of every weekly tree in the folder, so a request runs
+    a single query per zone. Zones whose weekly trees did not change since the last build are skipped
+    :param folder: The folder containing the weekly tree files
+    :return: list of merged indexes that were rebuilt
+    """
+    merged_folder = os.path.join(folder, util.MERGED_TREE_FOLDER)
+    try:
+        os.mkdir(merged_folder)
+    except OSError:
+        pass
+
+    weekly_files = {}
+    for filename in sorted(os.listdir(folder)):
+        zone = re.search(r'utm_(\d+)\.tree$', filename)
+        if zone:
+            weekly_files.setdefault(zone.group(1), []).append(filename)
+
+    merged_files = []
+    for zone, filenames in weekly_files.items():
+        merged_file = os.path.join(merged_folder, 'utm_{}.tree'.format(zone))
+        if os.path.isdir(merged_file) and load_tree_meta(merged_file).get('sources') == filenames:
+            continue
+        points = np.concatenate([load_tree(os.path.join(folder, filename)).data for filename in filenames])
+        save_tree(cKDTree(points), merged_file, extra_meta={'sources': filenames})
+        merged_files.append(merged_file)
+
+    # remove the merged indexes of zones that no longer have weekly trees
+    for filename in os.listdir(merged_folder):
+        zone = re.search(r'utm_(\d+)\.tree$', filename)
+        if zone and zone.group(1) not in weekly_files:
+            delete_files([filename], merged_folder)
+    return merged_files
+
+
+def disk_rectangles(radius):
+    """
+    Covers the cells whose centers lie within radius of a cell center with as few rectangles as possible
+    :param radius: radius in cells
+    :return: list of (first row offset, last row offset, half width) tuples
+    """
+    rectangles = []
+    for dy in range(-int(radius), int(radius) + 1):
+        half_width = int(np.floor(np.sqrt(radius ** 2 - dy ** 2) + 1e-9))
+        if rectangles and rectangles[-1][2] == half_width:
+            rectangles[-1] = (rectangles[-1][0], dy, half_width)
+        else:
+            rectangles.append((dy, dy, half_width))
+    return rectangles
+
+
+def build_density_grids(folder, cell_size):
+    """
+    Builds a DensityGrid next to every merged index. Zones whose grid would exceed DENSITY_GRID_MAX_CELLS are skipped
+    and keep using the trees
+    :param folder: The folder containing the weekly tree files
+    :param cell_size: Cell size in meters
+    :return: list of density grids that were rebuilt
+    """
+    merged_folder = os.path.join(folder, util.MERGED_TREE_FOLDER)
+    grid_files = []
+    for filename in os.listdir(merged_folder):
+        if not filename.endswith('.tree'):
+            continue
+        merged_file = os.path.join(merged_folder, filename)
+        grid_file = merged_file[:-len('.tree')] + '.grid'
+        sources = load_tree_meta(merged_file).get('sources')
+        if os.path.isdir(grid_file) and load_tree_meta(grid_file).get('sources') == sources:
+            continue
+
+        points = load_tree(merged_file).data
+        padding = max(util.PROXIMITY_RADII)
+        extent = np.ptp(points, axis=0) + 2 * padding
+        if np.prod(extent / cell_size + 1) > util.DENSITY_GRID_MAX_CELLS:
+            logging.info('Skipping density grid of ' + filename + ', too many cells')
+            shutil.rmtree(grid_file, ignore_errors=True)
+            continue
+        DensityGrid.build(points, cell_size, padding).save(grid_file, extra_meta={'sources': sources})
+        grid_files.append(grid_file)
+
+    # remove the grids of zones that no longer have a merged index
+    merged_files = os.listdir(merged_folder)
+    for filename in merged_files:
+        if filename.endswith('.grid') and filename[:-len('.grid')] + '.tree' not in merged_files:
+            shutil.rmtree(os.path.join(merged_folder, filename))
+    return grid_files
+
+
+def load_tree(path):
+    """
+    Loads a tree saved by save_tree. Arrays are memory mapped read only, so every process that loads the same index
+    shares the same pages. Legacy pickled .tree files are still supported
+    :param path: index directory or legacy pickle file
+    :return: cKDTree
+    """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    meta = load_tree_meta(path)
+    if meta['format_version'] > util.TREE_FORMAT_VERSION:
+        raise UnsupportedTreeFormatException(path)
+
+    points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+    structure = meta['structure']
+    if structure is None or structure['scipy_version'] != scipy.__version__:
+        return cKDTree(points, leafsize=meta['leafsize'], copy_data=False)
+
+    tree = cKDTree.__new__(cKDTree)
+    tree.__setstate__((np.load(os.path.join(path, 'tree_buffer.npy'), mmap_mode='r'), points, meta['n'], meta['m'],
+                       meta['leafsize'], np.array(structure['maxes']), np.array(structure['mins']),
+                       np.load(os.path.join(path, 'indices.npy'), mmap_mode='r'), None, None))
+    return tree
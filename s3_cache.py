@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import closing
+from botocore.exceptions import ClientError
+from config import settings
+
+# Folder and size cap of the object cache shared by aws_s3 and util, the folder defaults to a sibling of the tree folder
+S3_CACHE_FOLDER = settings['directories'].get('s3_cache_folder', os.path.join(
+    os.path.dirname(os.path.abspath(settings['directories']['current_tree_folder'])), 's3_cache'))
+S3_CACHE_MAX_BYTES = settings.get('s3_cache', {}).get('max_mb', 10240) * 2 ** 20
+# Objects not kept in the cache, trees are already kept on disk by util in the memory-mappable index format
+UNCACHED_SUFFIXES = tuple(settings.get('s3_cache', {}).get('uncached_suffixes', ['.tree']))
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+
+
+class S3ObjectCache:
+    """
+    Disk cache of S3 objects shared by every process using the same folder. Object files are named after the hash
+    of their bucket, key and ETag, and the index holds the ETag last seen for each key, so a cached object is
+    revalidated with a conditional GET and only downloaded again when it changed. Objects are evicted least recently
+    used first once the cache holds more than max_bytes. A lock file per key keeps processes and threads from
+    downloading the same object at once, and readers get an open file so an eviction never pulls it from under them
+    """
+    def __init__(self, folder=None, max_bytes=None):
+        self.folder = folder or S3_CACHE_FOLDER
+        self.max_bytes = S3_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        for sub_folder in ['objects', 'index', 'locks']:
+            os.makedirs(os.path.join(self.folder, sub_folder), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.stats_lock = threading.Lock()
+
+    def fetch(self, s3_conn, bucket, key):
+        """
+        Returns the object from the cache if its ETag is unchanged, downloading it otherwise
+        :param s3_conn: S3 client
+        :param bucket: bucket of the object
+        :param key: key of the object
+        :return: binary file object opened on the cached object, bytes downloaded (0 on a hit)
+        """
+        key_hash = hash_name(bucket, key)
+        index_path = os.path.join(self.folder, 'index', key_hash + '.json')
+        with FileLock(os.path.join(self.folder, 'locks', key_hash + '.lock')):
+            # Eviction does not take the key locks, opening the object first keeps it readable if it is evicted while
+            # being revalidated. An object already evicted is downloaded again
+            entry = read_json(index_path)
+            cached = None
+            if entry:
+                try:
+                    cached = open(self.object_path(entry['object']), 'rb')
+                except OSError:
+                    pass
+            try:
+                if cached:
+                    response = s3_conn.get_object(Bucket=bucket, Key=key, IfNoneMatch=entry['etag'])
+                else:
+                    response = s3_conn.get_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                if not cached or e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                    if cached:
+                        cached.close()
+                    raise
+                response = None
+            except Exception:
+                if cached:
+                    cached.close()
+                raise
+
+            if response is None:
+                # Not modified, mark the object as recently used
+                os.utime(cached.fileno())
+                f = cached
+                downloaded = 0
+            else:
+                if cached:
+                    cached.close()
+                f, downloaded = self.store(response, bucket, key, index_path, entry)
+
+        with self.stats_lock:
+            if downloaded:
+                self.misses += 1
+                self.bytes_downloaded += downloaded
+            else:
+                self.hits += 1
+        if downloaded:
+            self.evict()
+        return f, downloaded
+
+    def store(self, response, bucket, key, index_path, old_entry):
+        """
+        Streams a GET response into the cache and points the index entry of the key at it
+        :return: binary file object opened on the stored object, bytes downloaded
+        """
+        etag = response.get('ETag')
+        tmp_file = tempfile.NamedTemporaryFile(dir=os.path.join(self.folder, 'objects'), prefix='.',
+                                               suffix='.download', delete=False)
+        try:
+            with tmp_file, closing(response['Body']) as body:
+                shutil.copyfileobj(body, tmp_file, DOWNLOAD_CHUNK_SIZE)
+                downloaded = tmp_file.tell()
+            f = open(tmp_file.name, 'rb')
+            if etag is None:
+                # Objects without an ETag cannot be revalidated, they are read once and not kept
+                os.remove(tmp_file.name)
+                return f, downloaded
+
+            object_name = hash_name(bucket, key, etag)
+            os.replace(tmp_file.name, self.object_path(object_name))
+        except Exception:
+            if os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
+            raise
+
+        write_json(index_path, {'bucket': bucket, 'key': key, 'etag': etag, 'object': object_name})
+        if old_entry and old_entry['object'] != object_name and os.path.exists(self.object_path(old_entry['object'])):
+            os.remove(self.object_path(old_entry['object']))
+        return f, downloaded
+
+    def object_path(self, object_name):
+        return os.path.join(self.folder, 'objects', object_name)
+
+    def evict(self):
+        """
+        Removes the least recently used objects until the cache fits in max_bytes
+        """
+        with FileLock(os.path.join(self.folder, 'locks', 'evict.lock')):
+            objects = []
+            for entry in os.scandir(os.path.join(self.folder, 'objects')):
+                if not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    objects.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(x[1] for x in objects)
+            for _, size, path in sorted(objects):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+                logging.info('Evicted ' + path + ' from the S3 cache')
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss statistics of this process
+        """
+        with self.stats_lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes_downloaded': self.bytes_downloaded}
+
+
+class FileLock:
+    """
+    Exclusive fcntl lock of a file, held by one process or thread at a time
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def hash_name(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, value):
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_file, path)
+
+
+def fetch(s3_conn, bucket, key):
+    """
+    Gets an object through the shared cache, objects with a key ending in one of UNCACHED_SUFFIXES are read straight
+    from S3
+    :param s3_conn: S3 client
+    :param bucket: bucket of the object
+    :param key: key of the object
+    :return: binary file object, bytes downloaded
+    """
+    if key.endswith(UNCACHED_SUFFIXES):
+        response = s3_conn.get_object(Bucket=bucket, Key=key)
+        return response['Body'], response.get('ContentLength', 0)
+    return get_cache().fetch(s3_conn, bucket, key)
+
+
+def get_cache():
+    """
+    :return: S3ObjectCache of S3_CACHE_FOLDER shared by the download helpers, created on first use
+    """
+    global cache
+    with cache_lock:
+        if cache is None:
+            cache = S3ObjectCache()
+        return cache
+
+
+cache = None
+cache_lock = threading.Lock()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import os
+import re
+import time
+import logging
+import argparse
+import threading
+import util
+
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Listener, Client
+from config import settings
+
+# Shared secret of the router and worker connections, there is no default so every deployment sets its own
+AUTHKEY = settings['util_config'].get('zone_shard_authkey')
+
+# Connections the router opens to every worker, the number of queries a worker answers at once
+CONNECTIONS_PER_WORKER = settings['util_config'].get('zone_shard_connections', 4)
+CONNECT_RETRIES = 50
+CONNECT_DELAY = 0.1
+
+
+class ZoneShardWorker:
+    """
+    Answers the tree queries of the UTM zones it owns. Their trees stay loaded between queries and are reloaded
+    when a new snapshot is published under root
+    """
+    def __init__(self, zones, root=settings['directories']['current_tree_folder']):
+        self.zones = sorted(int(x) for x in zones)
+        self.root = root
+        self.data = util.util()
+        self.version = None
+        self.trees = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Loads the trees of the zones from the current snapshot if it changed since the last call
+        :return: snapshot version, dictionary mapping tree name relative to the snapshot to tree
+        """
+        folder = self.data.current_snapshot(self.root) or self.root
+        version = os.path.basename(folder)
+        with self.lock:
+            if version != self.version:
+                paths = self.data.load_needed_trees(self.zones, folder)
+                self.trees = dict((os.path.relpath(path, folder).replace(os.sep, '/'), util.load_tree(path))
+                                  for path in paths)
+                self.version = version
+                logging.info('Zone shard ' + str(self.zones) + ' loaded snapshot ' + version)
+            return self.version, self.trees
+
+    def handle(self, request):
+        """
+        :param request: ('list',) or ('query', tree name, (n, 2) array of UTM coordinates)
+        :return: (snapshot version, zones, tree names) or (n, len(PROXIMITY_RADII)) array of point counts
+        """
+        version, trees = self.refresh()
+        if request[0] == 'list':
+            return version, self.zones, sorted(trees)
+        if request[0] == 'query':
+            return util.count_within_radii(trees[request[1]], request[2], util.util.PROXIMITY_RADII)
+        raise ValueError('Unknown zone shard request ' + str(request[0]))
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ('ok', self.handle(request))
+                except Exception as e:
+                    logging.exception('Zone shard request failed')
+                    response = ('error', repr(e))
+                conn.send(response)
+
+    def serve(self, address, authkey=None):
+        """
+        Loads the trees and answers requests on address until the process is stopped, one thread per connection
+        :param address: (host, port) to listen on
+        :param authkey: Shared secret of the router and the workers, defaults to the zone_shard_authkey setting
+        """
+        authkey = require_authkey(authkey)
+        self.refresh()
+        with Listener(address, authkey=authkey) as listener:
+            logging.info('Zone shard ' + str(self.zones) + ' listening on ' + str(address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    logging.warning('Rejected zone shard connection: ' + str(e))
+                    continue
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+
+class ShardRouter:
+    """
+    Sends each tree query of multiprocess_query to the ZoneShardWorker owning the tree's zone. It has the
+    apply_async interface of ZoneQueryPool, so it is passed to multiprocess_query as its pool
+    """
+    def __init__(self, addresses, authkey=None, connections=CONNECTIONS_PER_WORKER):
+        authkey = require_authkey(authkey)
+        self.connections = {}
+        self.zone_workers = {}
+        self.tree_names = []
+        self.version = None
+        self.authkey = authkey
+        self.pending = 0
+        self.lock = threading.Lock()
+        for address in addresses:
+            self.connections[address] = Queue()
+            for _ in range(connections):
+                self.connections[address].put(connect(address, authkey))
+        self.executor = ThreadPoolExecutor(max_workers=connections * len(addresses))
+        self.refresh()
+
+    def call(self, address, request):
+        """
+        Sends a request to a worker over one of its idle connections
+        :param address: (host, port) of the worker
+        :param request: request tuple, see ZoneShardWorker.handle
+        :return: response of the worker
+        """
+        conn = self.connections[address].get()
+        try:
+            conn.send(request)
+            status, response = conn.recv()
+        except (EOFError, OSError):
+            # The worker went away, the next request opens a new connection
+            conn.close()
+            conn = connect(address, self.authkey)
+            raise
+        finally:
+            self.connections[address].put(conn)
+        if status == 'error':
+            raise ZoneShardException(str(address) + ': ' + response)
+        return response
+
+    def refresh(self):
+        """
+        Asks every worker for its zones, trees and snapshot version
+        """
+        zone_workers = {}
+        tree_names = []
+        versions = set()
+        for address in self.connections:
+            version, zones, names = self.call(address, ('list',))
+            versions.add(version)
+            tree_names += names
+            for zone in zones:
+                zone_workers[zone] = address
+        if len(versions) > 1:
+            logging.warning('Zone shards are on different snapshots: ' + str(sorted(versions)))
+        self.zone_workers = zone_workers
+        self.tree_names = tree_names
+        self.version = max(versions) if versions else None
+
+    def needed_trees(self, needed_zones):
+        """
+        Stand-in for load_needed_trees, the trees stay in the workers
+        :param needed_zones: UTM zones needed to calculate scores
+        :return: list of the tree names of the needed zones
+        """
+        self.refresh()
+        needed = set(int(x) for x in needed_zones)
+        missing = needed - set(self.zone_workers)
+        if missing:
+            raise ZoneShardException('No zone shard owns zones ' + str(sorted(missing)))
+        return [name for name in self.tree_names if tree_zone(name) in needed]
+
+    def apply_async(self, tree_path, coords):
+        """
+        Counts the points of a tree around the given coordinates in the worker owning its zone
+        :param tree_path: Name of the tree, as returned by needed_trees
+        :param coords: (n, 2) array of UTM coordinates
+        :return: ShardResult of a (n, len(PROXIMITY_RADII)) count array
+        """
+        address = self.zone_workers[tree_zone(tree_path)]
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self.call, address, ('query', tree_path, coords))
+        future.add_done_callback(self.task_done)
+        return ShardResult(future)
+
+    def task_done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def queue_depth(self):
+        """
+        :return: Number of queries submitted and not answered yet
+        """
+        return self.pending
+
+    def close(self):
+        self.executor.shutdown()
+        for connections in self.connections.values():
+            while not connections.empty():
+                connections.get().close()
+
+
+class ShardResult:
+    """
+    Result of ShardRouter.apply_async, with the get method of multiprocessing's AsyncResult
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def get(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class ZoneShardException(Exception):
+    pass
+
+
+def tree_zone(tree_path):
+    """
+    :param tree_path: Path or name of a weekly or merged tree
+    :return: UTM zone number of the tree
+    """
+    return int(re.search(r'utm_(\d+)\.tree$', os.path.basename(tree_path)).group(1))
+
+
+def parse_address(address):
+    """
+    :param address: host:port string
+    :return: (host, port) tuple
+    """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def require_authkey(authkey=None):
+    """
+    :param authkey: Shared secret of the router and the workers, defaults to the zone_shard_authkey setting
+    :return: authkey as bytes
+    """
+    authkey = authkey or AUTHKEY
+    if not authkey:
+        raise ZoneShardException('zone_shard_authkey is not configured, refusing to start zone shards without it')
+    return authkey.encode('utf-8') if isinstance(authkey, str) else authkey
+
+
+def connect(address, authkey):
+    """
+    Connects to a worker, waiting for it while it is still loading its trees
+    """
+    for attempt in range(CONNECT_RETRIES):
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if attempt == CONNECT_RETRIES - 1:
+                raise
+            time.sleep(CONNECT_DELAY)
+
+
+def run_worker(zones, address, root, authkey=None):
+    ZoneShardWorker(zones, root).serve(address, authkey)
+
+
+def start_local_shards(zone_groups, root=settings['directories']['current_tree_folder'], host='localhost',
+                       base_port=6100, authkey=None):
+    """
+    Starts one worker process per group of zones on this machine, for testing the sharded setup
+    :param zone_groups: list of lists of UTM zones, one per worker
+    :param root: The folder holding the tree snapshots
+    :param host: Host the workers listen on
+    :param base_port: Port of the first worker, the next ones use the following ports
+    :param authkey: Shared secret of the router and the workers, defaults to the zone_shard_authkey setting
+    :return: list of worker processes, list of their (host, port) addresses
+    """
+    authkey = require_authkey(authkey)
+    processes = []
+    addresses = []
+    for i, zones in enumerate(zone_groups):
+        address = (host, base_port + i)
+        process = Process(target=run_worker, args=(zones, address, root, authkey), daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+    return processes, addresses
+
+
+parser = argparse.ArgumentParser(description='zone_shard - Serve the tree queries of a group of UTM zones')
+parser.add_argument('-z', '--zones', nargs='+', required=True,
+                    help='Required: Zones of the worker, or comma separated zone groups with --local.')
+parser.add_argument('-a', '--address', default='localhost:6100', help='Optional: host:port to listen on, the '
+                                                                     'first port with --local.')
+parser.add_argument('-r', '--root', default=settings['directories']['current_tree_folder'],
+                    help='Optional: Folder holding the tree snapshots.')
+parser.add_argument('-l', '--local', action='store_true',
+                    help='Optional: Start one local worker per zone group, e.g. --local -z 10,11 12,13')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    host, port = parse_address(args.address)
+    if args.local:
+        workers, worker_addresses = start_local_shards([x.split(',') for x in args.zones], args.root, host, port)
+        print('Zone shards: ' + ' '.join('%s:%d' % x for x in worker_addresses))
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker(args.zones, (host, port), args.root)